@@ -0,0 +1,334 @@
+import io
+import os
+import json
+import subprocess
+import sys
+import tempfile
+import time
+from copy import deepcopy
+
+import click
+
+import yaml
+from steamroll import _lookup_children, _lookup_child, _fixup_refs, _kv, _compile_path, _read_yaml, ScalarRef, _REF_RULES, _ID_PATHS
+from steamroll import EventDumper, EventLoader, YamlSerializer, _SERIALIZERS
+
+
+def synthetic_event(items=200, variations=5, vouchers=5000, questions=50, subevents=50):
+    return {
+        'event': {'slug': 'bench', 'seat_category_mapping': {'cat%d' % i: 1 + i for i in range(0, items, 10)}},
+        'taxrules': [{'id': 1 + i} for i in range(2)],
+        'categories': [{'id': 1 + i, 'cross_selling_match_products': [1 + i]} for i in range(10)],
+        'items': [{
+            'id': 1 + i,
+            'category': 1 + i % 10,
+            'tax_rule': 1 + i % 2,
+            'addons': [{'addon_category': 1 + (i + 1) % 10}],
+            'variations': [{'id': 100000 + i * variations + j} for j in range(variations)],
+        } for i in range(items)],
+        'quotas': [{
+            'id': 1 + i,
+            'items': [1 + i],
+            'variations': [100000 + i * variations + j for j in range(variations)],
+            'subevent': None,
+        } for i in range(items)],
+        'questions': [{
+            'id': 1 + i,
+            'items': [1 + j for j in range(i % items, items, 7)],
+            'dependency_question': i if i else None,
+        } for i in range(questions)],
+        'vouchers': [{
+            'id': 1 + i,
+            'item': 1 + i % items,
+            'variation': 100000 + (i % items) * variations + i % variations,
+            'subevent': 200000 + i % subevents if subevents else None,
+        } for i in range(vouchers)],
+        'discounts': [{'condition_limit_products': [1 + i], 'benefit_limit_products': [1 + i]} for i in range(10)],
+        'subevents': [{
+            'id': 200000 + i,
+            'item_price_overrides': [{'item': 1 + i % items}],
+            'variation_price_overrides': [{'variation': 100000 + (i % items) * variations}],
+        } for i in range(subevents)],
+    }
+
+
+# the linear scan _fixup_refs used before the reference index was introduced
+def _fixup_refs_linear(obj, where, to_where, to_what):
+    to_what = to_what.split('.')[1:]
+    to_objs = _lookup_children(obj, to_where, with_path=[])
+    from_obj = _lookup_children(obj, where, assign_refs=True)
+    for from_id in from_obj:
+        try:
+            path, ref = next((path, y) for (path, y) in to_objs if _lookup_child(y, to_what) == from_id)
+            from_id.ref = path + to_what
+        except StopIteration:
+            pass
+
+
+# the recursive lookup used before path expressions were compiled, minus the in-place mutation of path[0]
+def _lookup_children_recursive(obj, path, assign_refs=False, ignore_key_errors=False, with_path=None):
+    if isinstance(path, str): path = path.split('.')[1:]
+    if path[0] != '*':
+        key = path[0].rstrip('?')
+        try:
+            child = obj[key]
+        except KeyError:
+            if ignore_key_errors or path[0].endswith('?'):
+                return []
+            raise
+        if len(path) == 1:
+            if assign_refs and not isinstance(child, ScalarRef): child = obj[key] = ScalarRef(child)
+            return [(with_path + [key], child)] if with_path is not None else [child]
+        return _lookup_children_recursive(child, path[1:], assign_refs, ignore_key_errors, with_path + [key] if with_path is not None else None)
+    if len(path) == 1:
+        return [(with_path + [i], child) for i, child in _kv(obj)] if with_path is not None else [child for i, child in _kv(obj)]
+    return [el for i, x in _kv(obj) for el in _lookup_children_recursive(x, path[1:], assign_refs, ignore_key_errors, with_path + [i] if with_path is not None else None)]
+
+
+def _refs(obj):
+    return [(r.v, r.ref) for rule in _REF_RULES for r in _lookup_children(obj, rule[0], ignore_key_errors=True)]
+
+
+def _timed(fn, doc, repeat):
+    best = None
+    for _ in range(repeat):
+        d = deepcopy(doc)
+        start = time.perf_counter()
+        result = fn(d)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, d, result
+
+
+@click.group()
+def cli():
+    pass
+
+@cli.command('refs')
+@click.option('--items', default=200, show_default=True)
+@click.option('--variations', default=5, show_default=True)
+@click.option('--vouchers', default=5000, show_default=True)
+@click.option('--questions', default=50, show_default=True)
+@click.option('--repeat', default=3, show_default=True)
+def bench_refs(items, variations, vouchers, questions, repeat):
+    doc = synthetic_event(items, variations, vouchers, questions)
+    linear, linear_doc, _ = _timed(lambda d: [_fixup_refs_linear(d, *rule) for rule in _REF_RULES], doc, repeat)
+    indexed, indexed_doc, _ = _timed(lambda d: _fixup_refs(d, _REF_RULES), doc, repeat)
+    assert _refs(linear_doc) == _refs(indexed_doc), "indexed resolution differs from linear scan"
+    print("linear scan:  {:9.4f}s".format(linear))
+    print("ref index:    {:9.4f}s".format(indexed))
+    print("speedup:      {:9.1f}x".format(linear / indexed))
+
+
+@cli.command('paths')
+@click.option('--items', default=200, show_default=True)
+@click.option('--variations', default=5, show_default=True)
+@click.option('--vouchers', default=5000, show_default=True)
+@click.option('--questions', default=50, show_default=True)
+@click.option('--repeat', default=3, show_default=True)
+def bench_paths(items, variations, vouchers, questions, repeat):
+    doc = synthetic_event(items, variations, vouchers, questions)
+    paths = list(_read_yaml('defaults.yml')) + _ID_PATHS + [rule[1] for rule in _REF_RULES]
+    recursive, _, recursive_found = _timed(lambda d: [len(_lookup_children_recursive(d, path, ignore_key_errors=True, with_path=[])) for path in paths], doc, repeat)
+    compiled, _, compiled_found = _timed(lambda d: [sum(1 for _ in _compile_path(path).walk(d, ignore_key_errors=True, with_path=[])) for path in paths], doc, repeat)
+    assert recursive_found == compiled_found, "compiled walker differs from recursive lookup"
+    print("{} paths, {} matches".format(len(paths), sum(compiled_found)))
+    print("recursive:    {:9.4f}s".format(recursive))
+    print("compiled:     {:9.4f}s".format(compiled))
+    print("speedup:      {:9.1f}x".format(recursive / compiled))
+
+
+class PyEventDumper(yaml.SafeDumper):
+    pass
+
+class PyEventLoader(yaml.SafeLoader):
+    pass
+
+PyEventDumper.add_representer(ScalarRef, EventDumper.yaml_representers[ScalarRef])
+PyEventLoader.add_constructor('ref', EventLoader.yaml_constructors['ref'])
+
+
+@cli.command('serializers')
+@click.option('--items', default=200, show_default=True)
+@click.option('--variations', default=5, show_default=True)
+@click.option('--vouchers', default=5000, show_default=True)
+@click.option('--questions', default=50, show_default=True)
+@click.option('--repeat', default=3, show_default=True)
+def bench_serializers(items, variations, vouchers, questions, repeat):
+    doc = synthetic_event(items, variations, vouchers, questions)
+    _fixup_refs(doc, _REF_RULES)
+    backends = {'yaml (python)': YamlSerializer(PyEventDumper, PyEventLoader), **_SERIALIZERS}
+    print("{:16} {:>9} {:>9} {:>10}".format('backend', 'dump', 'load', 'size'))
+    for name, serializer in backends.items():
+        try:
+            dump, load, size = None, None, 0
+            for _ in range(repeat):
+                f = io.BytesIO() if serializer.binary else io.StringIO()
+                start = time.perf_counter()
+                serializer.write(f, doc.items())
+                elapsed = time.perf_counter() - start
+                dump = elapsed if dump is None else min(dump, elapsed)
+                size = len(f.getvalue())
+                f.seek(0)
+                start = time.perf_counter()
+                serializer.read(f)
+                elapsed = time.perf_counter() - start
+                load = elapsed if load is None else min(load, elapsed)
+        except click.ClickException as e:
+            print("{:16} skipped: {}".format(name, e.message))
+            continue
+        print("{:16} {:8.4f}s {:8.4f}s {:9.0f}k".format(name, dump, load, size / 1024))
+
+
+def _best_run(args, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(args, stdout=subprocess.DEVNULL, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+@cli.command('startup')
+@click.option('--repeat', default=10, show_default=True)
+@click.option('--max-ms', type=float, help='Fail if `steamroll.py --help` takes longer than this')
+def bench_startup(repeat, max_ms):
+    # these are only needed by some subcommands and must not be imported just to start the CLI
+    heavy = ['bs4', 'requests', 'ruamel.yaml']
+    loaded = subprocess.run([sys.executable, '-c', 'import sys, steamroll; print(*[m for m in {!r} if m in sys.modules])'.format(heavy)],
+                            capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+    interpreter = _best_run([sys.executable, '-c', 'pass'], repeat)
+    startup = _best_run([sys.executable, 'steamroll.py', '--help'], repeat)
+    print("python:       {:9.1f}ms".format(interpreter * 1000))
+    print("--help:       {:9.1f}ms".format(startup * 1000))
+    print("overhead:     {:9.1f}ms".format((startup - interpreter) * 1000))
+    if loaded:
+        raise click.ClickException("imported at startup: " + ", ".join(loaded))
+    if max_ms is not None and startup * 1000 > max_ms:
+        raise click.ClickException("--help took {:.1f}ms, more than {:.1f}ms".format(startup * 1000, max_ms))
+
+
+# runs steamroll.py and reports its peak memory on the last line of stderr
+_MEASURED_RUN = """
+import resource, runpy, sys
+sys.argv = ['steamroll.py'] + sys.argv[1:]
+try:
+    runpy.run_path('steamroll.py', run_name='__main__')
+finally:
+    sys.stderr.write('\\n{}\\n'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+"""
+
+
+def _run_measured(args):
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-c', _MEASURED_RUN] + args, capture_output=True, text=True,
+                          cwd=os.path.dirname(os.path.abspath(__file__)), env={**os.environ, 'PRETIX_TOKEN': 'bench'})
+    elapsed = time.perf_counter() - start
+    if proc.returncode:
+        raise click.ClickException("{} failed:\n{}{}".format(' '.join(args[:2]), proc.stdout, proc.stderr))
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = int(proc.stderr.split()[-1]) * (1 if sys.platform == 'darwin' else 1024)
+    return elapsed, peak
+
+
+def _change(value, baseline):
+    return "{:+.0f}%".format((value / baseline - 1) * 100) if baseline else "-"
+
+
+@cli.command('e2e')
+@click.option('--items', default=50, show_default=True)
+@click.option('--variations', default=3, show_default=True)
+@click.option('--vouchers', default=5000, show_default=True)
+@click.option('--subevents', default=0, show_default=True)
+@click.option('--questions', default=20, show_default=True)
+@click.option('--latency', default=0.01, show_default=True, help='Seconds the mock server waits before answering a request')
+@click.option('--fail-every', default=0, show_default=True, help='Answer every n-th request with 429 Too Many Requests')
+@click.option('--jobs', '-j', default=8, show_default=True)
+@click.option('--baseline', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json'), show_default=True)
+@click.option('--save-baseline', is_flag=True, help='Store the results as the new baseline')
+def bench_e2e(items, variations, vouchers, subevents, questions, latency, fail_every, jobs, baseline, save_baseline):
+    from mock_pretix import MockPretix, generate_event
+    config = {'items': items, 'variations': variations, 'vouchers': vouchers, 'subevents': subevents, 'questions': questions,
+              'latency': latency, 'fail_every': fail_every, 'jobs': jobs}
+    source = generate_event('source', items, variations, vouchers, subevents, questions)
+    objects = sum(len(value) for value in source.values() if isinstance(value, list)) + sum(len(item['variations']) for item in source['items'])
+    workdir = tempfile.mkdtemp(prefix='steamroll-bench-')
+    event_file = os.path.join(workdir, 'source.yml')
+
+    results = {}
+    with MockPretix(latency=latency, fail_every=fail_every) as mock:
+        mock.add_event('bench', source)
+        commands = {
+            'fetch': ['event', 'fetch', mock.url, 'bench', 'source', '-f', event_file, '--no-cache', '-j', str(jobs)],
+            'create': ['event', 'create', mock.url, 'bench', 'copy', '-f', event_file, '-j', str(jobs)],
+            'update': ['event', 'update', mock.url, 'bench', 'copy', '-f', event_file, '-j', str(jobs)],
+            'clone': ['event', 'clone', mock.url, 'bench', 'source', mock.url, 'bench', 'clone', '-j', str(jobs)],
+        }
+        for name, args in commands.items():
+            mock.reset_counts()
+            elapsed, peak = _run_measured(args)
+            counts = dict(mock.counts)
+            results[name] = {'seconds': elapsed, 'objects_per_second': objects / elapsed, 'peak_memory': peak,
+                             'requests': sum(n for key, n in counts.items() if key != '429'), 'throttled': counts.get('429', 0)}
+
+    stored = None
+    if os.path.exists(baseline):
+        with open(baseline) as f:
+            stored = json.load(f)
+        if stored.get('config') != config:
+            print("baseline {} was measured with {}, not comparing".format(baseline, stored.get('config')))
+            stored = None
+    print("{} objects, {}s latency per request".format(objects, latency))
+    print("{:8} {:>9} {:>10} {:>9} {:>6} {:>10}   {}".format('command', 'time', 'objects/s', 'requests', '429s', 'peak mem', 'vs. baseline (time, memory, requests)'))
+    for name, r in results.items():
+        base = stored['results'].get(name) if stored else None
+        print("{:8} {:>8.2f}s {:>10.0f} {:>9} {:>6} {:>7.1f}MiB   {}".format(
+            name, r['seconds'], r['objects_per_second'], r['requests'], r['throttled'], r['peak_memory'] / 1024 / 1024,
+            ", ".join([_change(r['seconds'], base['seconds']), _change(r['peak_memory'], base['peak_memory']), _change(r['requests'], base['requests'])]) if base else "-"))
+    if save_baseline:
+        with open(baseline, 'w') as f:
+            json.dump({'config': config, 'results': results}, f, indent=2)
+            f.write('\n')
+        print("saved baseline to " + baseline)
+
+
+def _steamroll(*args):
+    proc = subprocess.run([sys.executable, 'steamroll.py'] + list(args), capture_output=True, text=True,
+                          cwd=os.path.dirname(os.path.abspath(__file__)), env={**os.environ, 'PRETIX_TOKEN': 'bench'})
+    if proc.returncode:
+        raise click.ClickException("{} failed:\n{}{}".format(' '.join(args[:2]), proc.stdout, proc.stderr))
+    return proc.stdout
+
+
+@cli.command('check-update')
+def check_update():
+    # nested objects of existing items that refer to objects which are new in the file, e.g. an addon of a new category
+    from mock_pretix import MockPretix, generate_event
+    event_file = os.path.join(tempfile.mkdtemp(prefix='steamroll-check-'), 'source.json')
+    with MockPretix() as mock:
+        mock.add_event('bench', generate_event('source', items=4, variations=1, vouchers=5, questions=2))
+        _steamroll('event', 'fetch', mock.url, 'bench', 'source', '-f', event_file, '--no-cache')
+        with open(event_file) as f:
+            event = json.load(f)
+        event['categories'].append({'name': {'en': 'New category'}, 'position': len(event['categories'])})
+        event['items'].append({'name': {'en': 'New item'}, 'default_price': '1.00', 'position': len(event['items'])})
+        event['items'][0]['addons'] = [{'addon_category': {'$ref': ['categories', len(event['categories']) - 1, 'id']}, 'min_count': 0, 'max_count': 1}]
+        event['items'][1]['bundles'] = [{'bundled_item': {'$ref': ['items', len(event['items']) - 1, 'id']}, 'bundled_variation': None, 'count': 1}]
+        with open(event_file, 'w') as f:
+            json.dump(event, f)
+        update = ['event', 'update', mock.url, 'bench', 'source', '-f', event_file]
+        planned = _steamroll(*update, '--dry-run').splitlines()
+        print("\n".join(planned))
+        for endpoint in ['/categories/', '/items/', '/addons/', '/bundles/']:
+            if not any(line.split()[:1] == ['POST'] and line.split()[1].endswith(endpoint) for line in planned):
+                raise click.ClickException("no POST to {} planned".format(endpoint))
+        _steamroll(*update)
+        left = _steamroll(*update, '--dry-run')
+        if left.strip():
+            raise click.ClickException("changes left after the update:\n" + left)
+    print("ok")
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,384 @@
+import itertools
+import json
+import random
+import time
+from copy import deepcopy
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Lock, Thread
+from urllib.parse import urlsplit, parse_qs
+
+import click
+
+
+# a stand-in for the parts of the pretix REST API and control panel that steamroll.py talks to, for offline benchmarks
+
+_COLLECTIONS = ['taxrules', 'categories', 'items', 'quotas', 'item_meta_properties', 'questions', 'vouchers', 'discounts', 'subevents']
+
+_BULK_COLLECTIONS = {'vouchers'}
+
+# fields pointing at another collection of the same event, which pretix checks on creation and when patching
+_REF_FIELDS = {
+    'items': {'tax_rule': 'taxrules'},
+    'vouchers': {'quota': 'quotas'},
+}
+
+_EVENT_DEFAULTS = {'live': False, 'has_subevents': False, 'seat_category_mapping': {}, 'item_meta_properties': {}}
+
+# fields pretix always returns, even when they were left out on creation
+_CREATE_DEFAULTS = {
+    'categories': {'internal_name': None, 'description': {}, 'is_addon': False},
+    'items': {'category': None, 'tax_rule': None, 'internal_name': None, 'variations': [], 'addons': [], 'bundles': []},
+    'quotas': {'items': [], 'variations': [], 'subevent': None},
+    'questions': {'items': [], 'options': [], 'dependency_question': None, 'dependency_values': []},
+    'vouchers': {'item': None, 'variation': None, 'quota': None, 'subevent': None, 'redeemed': 0},
+    'discounts': {'condition_limit_products': [], 'benefit_limit_products': []},
+    'subevents': {'item_price_overrides': [], 'variation_price_overrides': [], 'meta_data': {}},
+}
+
+_PAYMENT_PROVIDERS = {
+    'banktransfer': {'payment_banktransfer__enabled': True, 'payment_banktransfer_bank_details_type': 'sepa', 'payment_banktransfer_bank_details_sepa_name': 'Example'},
+    'stripe': {'payment_stripe__enabled': False},
+}
+
+
+def generate_event(slug, items=20, variations=3, vouchers=1000, subevents=0, questions=10, seed=0):
+    rnd = random.Random(seed)
+    ids = itertools.count(1)
+    categories = [{'id': next(ids), 'name': {'en': 'Category %d' % i}, 'internal_name': None, 'description': {'en': ''}, 'position': i,
+                   'is_addon': False} for i in range(max(1, items // 10))]
+    taxrules = [{'id': next(ids), 'name': {'en': 'VAT'}, 'rate': '19.00', 'price_includes_tax': True}]
+    item_list = []
+    for i in range(items):
+        item_list.append({
+            'id': next(ids), 'category': categories[i % len(categories)]['id'], 'name': {'en': 'Item %d' % i}, 'internal_name': None,
+            'default_price': '%d.00' % rnd.randint(5, 200), 'tax_rate': '19.00', 'tax_rule': taxrules[0]['id'], 'active': True, 'admission': True, 'position': i,
+            'has_variations': bool(variations),
+            'variations': [{'id': next(ids), 'value': {'en': 'Variation %d' % j}, 'default_price': None, 'price': '10.00', 'active': True,
+                            'position': j} for j in range(variations)],
+            'addons': [], 'bundles': [],
+        })
+    start = datetime(2030, 1, 1, 10, tzinfo=timezone.utc)
+    subevent_list = [{'id': next(ids), 'name': {'en': 'Date %d' % i}, 'event': slug, 'active': True,
+                      'date_from': (start + timedelta(days=i)).isoformat().replace('+00:00', 'Z'), 'date_to': None, 'location': None,
+                      'item_price_overrides': [], 'variation_price_overrides': [], 'meta_data': {}}
+                     for i in range(subevents)]
+    # every third date is more expensive
+    for subevent in subevent_list[::3]:
+        subevent['item_price_overrides'] = [{'item': item['id'], 'price': '%d.00' % rnd.randint(5, 200), 'disabled': False} for item in item_list[:2]]
+        subevent['variation_price_overrides'] = [{'variation': v['id'], 'price': '15.00', 'disabled': False} for v in item_list[0]['variations']] if items else []
+    # an event series needs quotas per date, here one shared by the first few items
+    quota_list = [{'id': next(ids), 'name': 'Quota %d' % i, 'size': rnd.randint(10, 1000), 'items': [item['id']],
+                   'variations': [v['id'] for v in item['variations']], 'subevent': None, 'close_when_sold_out': False}
+                  for i, item in enumerate(item_list)] if not subevents else [
+                  {'id': next(ids), 'name': 'Capacity', 'size': rnd.randint(10, 1000), 'items': [item['id'] for item in item_list[:5]],
+                   'variations': [v['id'] for item in item_list[:5] for v in item['variations']], 'subevent': subevent['id'], 'close_when_sold_out': False}
+                  for subevent in subevent_list]
+    question_list = [{'id': next(ids), 'question': {'en': 'Question %d' % i}, 'type': 'S', 'required': False, 'position': i,
+                      'items': [item['id'] for item in item_list[i % items::max(1, questions)]] if items else [],
+                      'identifier': 'Q%04d' % i, 'ask_during_checkin': False, 'options': [], 'dependency_question': None,
+                      'dependency_values': []} for i in range(questions)]
+    for i, question in enumerate(question_list[1:], 1):
+        if i % 3 == 0:
+            question['dependency_question'] = question_list[i - 1]['id']
+    voucher_list = []
+    for i in range(vouchers):
+        item = item_list[i % items] if items else None
+        voucher_list.append({'id': next(ids), 'code': 'BENCH%08d' % i, 'max_usages': 1, 'redeemed': 0, 'valid_until': None,
+                             'block_quota': False, 'allow_ignore_quota': False, 'price_mode': 'none', 'value': None,
+                             'item': item and item['id'], 'variation': item and item['variations'] and item['variations'][i % len(item['variations'])]['id'],
+                             'quota': None, 'tag': 'bench', 'comment': '', 'subevent': subevent_list[i % subevents]['id'] if subevents else None})
+    return {
+        'event': {'name': {'en': 'Benchmark %s' % slug}, 'slug': slug, 'live': False, 'testmode': True, 'currency': 'EUR',
+                  'date_from': '2030-01-01T10:00:00Z', 'date_to': None, 'is_public': True, 'has_subevents': bool(subevents),
+                  'seat_category_mapping': {}, 'item_meta_properties': {}, 'plugins': ['pretix.plugins.banktransfer'], 'meta_data': {}},
+        'settings': {'locale': 'en', 'locales': ['en'], 'contact_mail': 'bench@example.com', 'imprint_url': None},
+        'taxrules': taxrules,
+        'categories': categories,
+        'items': item_list,
+        'quotas': quota_list,
+        'item_meta_properties': [],
+        'questions': question_list,
+        'vouchers': voucher_list,
+        'discounts': [{'id': next(ids), 'internal_name': 'Discount', 'active': True, 'condition_limit_products': [item_list[0]['id']] if items else [],
+                       'benefit_limit_products': []}],
+        'subevents': subevent_list,
+    }
+
+
+class MockPretix:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, fail_every=0, retry_after=0.05, page_size=50):
+        self.latency = latency
+        self.fail_every = fail_every
+        self.retry_after = retry_after
+        self.page_size = page_size
+        self.events = {}
+        self.counts = {}
+        self._requests = 0
+        self._ids = itertools.count(1000000)
+        self._lock = Lock()
+        self._thread = None
+        mock = self
+
+        class Handler(_Handler):
+            pass
+        Handler.mock = mock
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def add_event(self, organizer, data):
+        event = {'event': dict(data['event'])}
+        event['event']['public_url'] = '{}/{}/{}/'.format(self.url, organizer, data['event']['slug'])
+        event['settings'] = dict(data.get('settings', {}))
+        for name in _COLLECTIONS:
+            event[name] = {obj['id']: obj for obj in data.get(name, [])}
+        self.events[organizer, data['event']['slug']] = event
+        return event
+
+    def next_id(self):
+        return next(self._ids)
+
+    def count(self, key):
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def reset_counts(self):
+        with self._lock:
+            self.counts = {}
+
+    def start(self):
+        self._thread = Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def _parse_date(value):
+    date = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return date if date.tzinfo else date.replace(tzinfo=timezone.utc)
+
+# the list filters of pretix that steamroll.py uses
+_FILTERS = {
+    'date_from_after': lambda obj, value: _parse_date(obj['date_from']) >= _parse_date(value),
+    'date_from_before': lambda obj, value: _parse_date(obj['date_from']) <= _parse_date(value),
+}
+
+def _filter(objects, query):
+    for key, value in query.items():
+        if key in _FILTERS:
+            objects = [obj for obj in objects if _FILTERS[key](obj, value)]
+    return objects
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, which would otherwise wait for the delayed ack of the client
+    disable_nagle_algorithm = True
+    mock = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PATCH(self):
+        self._handle('PATCH')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def _handle(self, method):
+        mock = self.mock
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        mock.count(method)
+        if mock.latency:
+            time.sleep(mock.latency)
+        if mock.fail_every:
+            with mock._lock:
+                mock._requests += 1
+                fail = mock._requests % mock.fail_every == 0
+            if fail:
+                mock.count('429')
+                return self._send(429, {'detail': 'Request was throttled.'}, headers={'Retry-After': str(mock.retry_after)})
+        url = urlsplit(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        path = [part for part in url.path.split('/') if part]
+        try:
+            if path[:2] == ['api', 'v1']:
+                if not self.headers.get('Authorization'):
+                    return self._send(401, {'detail': 'Authentication credentials were not provided.'})
+                data = json.loads(body) if body else None
+                with mock._lock:
+                    code, result = self._api(method, path[2:], query, data)
+                if code == 200 and method == 'GET' and isinstance(result, list):
+                    return self._list(_filter(result, query), query)
+                return self._send(code, result)
+            if path[:1] == ['control']:
+                return self._control(path[1:])
+        except (KeyError, IndexError, ValueError):
+            pass
+        self._send(404, {'detail': 'Not found.'})
+
+    def _api(self, method, path, query, data):
+        mock = self.mock
+        if path == ['organizers']:
+            return 200, [{'slug': org} for org in sorted({org for org, ev in mock.events})]
+        organizer = path[1]
+        if path[2:] == ['events']:
+            if method == 'POST':
+                if (organizer, data['slug']) in mock.events:
+                    return 400, {'slug': ['This slug has already been used for a different event.']}
+                event = mock.add_event(organizer, {'event': {**data, **{key: value for key, value in _EVENT_DEFAULTS.items() if key not in data}}})
+                return 201, event['event']
+            return 200, [event['event'] for (org, ev), event in mock.events.items() if org == organizer]
+        event = mock.events[organizer, path[3]]
+        rest = path[4:]
+        if not rest:
+            if method == 'DELETE':
+                del mock.events[organizer, path[3]]
+                return 204, None
+            if method == 'PATCH':
+                event['event'].update(data)
+            return 200, event['event']
+        if rest == ['settings']:
+            if method == 'PATCH':
+                event['settings'].update(data)
+            return 200, event['settings']
+        collection = event[rest[0]]
+        if rest[1:] == ['batch_create'] and rest[0] in _BULK_COLLECTIONS and method == 'POST':
+            errors = [self._invalid_refs(event, rest[0], obj) for obj in data]
+            if any(errors):
+                return 400, errors
+            return 201, [self._create(rest[0], collection, obj) for obj in data]
+        if len(rest) == 1:
+            if method == 'POST':
+                if rest[0] == 'subevents':
+                    data = dict(data, event=path[3])
+                errors = self._invalid_refs(event, rest[0], data)
+                if errors:
+                    return 400, errors
+                return 201, self._create(rest[0], collection, data)
+            # like pretix, positioned objects are listed by position
+            return 200, sorted(collection.values(), key=lambda obj: (obj.get('position') or 0, obj['id']))
+        obj = collection[int(rest[1])]
+        if len(rest) >= 3:
+            nested = {v['id']: v for v in obj.setdefault(rest[2], [])}
+            if len(rest) == 3:
+                if method == 'POST':
+                    created = dict(data, id=mock.next_id())
+                    obj[rest[2]].append(created)
+                    return 201, created
+                return 200, list(nested.values())
+            child = nested[int(rest[3])]
+            if method == 'DELETE':
+                obj[rest[2]].remove(child)
+                return 204, None
+            if method == 'PATCH':
+                child.update(data)
+            return 200, child
+        if method == 'DELETE':
+            del collection[obj['id']]
+            return 204, None
+        if method == 'PATCH':
+            errors = self._invalid_refs(event, rest[0], data)
+            if errors:
+                return 400, errors
+            obj.update(data)
+        return 200, obj
+
+    def _invalid_refs(self, event, name, data):
+        return {field: ['Invalid pk "{}" - object does not exist.'.format(data[field])]
+                for field, target in _REF_FIELDS.get(name, {}).items() if data.get(field) is not None and data[field] not in event[target]}
+
+    def _create(self, name, collection, data):
+        obj = {**data, 'id': self.mock.next_id()}
+        for key, value in _CREATE_DEFAULTS.get(name, {}).items():
+            obj.setdefault(key, deepcopy(value))
+        if name == 'items':
+            for key in ('variations', 'addons', 'bundles'):
+                obj[key] = [dict(nested, id=self.mock.next_id()) for nested in obj[key]]
+        collection[obj['id']] = obj
+        return obj
+
+    def _list(self, objects, query):
+        page = int(query.get('page', 1))
+        page_size = min(int(query.get('page_size', self.mock.page_size)), self.mock.page_size)
+        results = objects[(page - 1) * page_size:page * page_size]
+        next_url = None
+        if page * page_size < len(objects):
+            params = {**query, 'page': page + 1}
+            next_url = 'http://{}{}?{}'.format(self.headers['Host'], urlsplit(self.path).path, '&'.join('{}={}'.format(k, v) for k, v in params.items()))
+        self._send(200, {'count': len(objects), 'next': next_url, 'previous': None, 'results': results})
+
+    def _control(self, path):
+        # event/{organizer}/{event}/settings/payment[/{provider}]
+        if path[0] != 'event' or path[3:5] != ['settings', 'payment'] or (path[1], path[2]) not in self.mock.events:
+            return self._send(404, {'detail': 'Not found.'})
+        if len(path) == 5:
+            links = ''.join('<tr><td><a href="/control/event/{}/{}/settings/payment/{}">{}</a></td></tr>'.format(path[1], path[2], key, key)
+                            for key in _PAYMENT_PROVIDERS)
+            return self._send_html('<table class="table-payment-providers">{}</table>'.format(links))
+        inputs = ''.join('<input type="checkbox" name="{}"{}>'.format(key, ' checked' if value else '') if isinstance(value, bool)
+                         else '<input type="text" name="{}" value="{}">'.format(key, value)
+                         for key, value in _PAYMENT_PROVIDERS[path[5]].items())
+        self._send_html('<form class="form-plugins"><input type="hidden" name="csrfmiddlewaretoken" value="x">{}</form>'.format(inputs))
+
+    def _send_html(self, html):
+        self._send(200, '<html><body>{}</body></html>'.format(html).encode('utf-8'), content_type='text/html; charset=utf-8')
+
+    def _send(self, code, result, headers={}, content_type='application/json'):
+        data = result if isinstance(result, bytes) else b'' if result is None else json.dumps(result).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@click.command()
+@click.option('--port', default=8000, show_default=True)
+@click.option('--latency', default=0.0, show_default=True, help='Seconds to wait before answering each request')
+@click.option('--fail-every', default=0, show_default=True, help='Answer every n-th request with 429 Too Many Requests')
+@click.option('--organizer', default='bench', show_default=True)
+@click.option('--event', default='source', show_default=True)
+@click.option('--items', default=20, show_default=True)
+@click.option('--variations', default=3, show_default=True)
+@click.option('--vouchers', default=1000, show_default=True)
+@click.option('--subevents', default=0, show_default=True)
+@click.option('--questions', default=10, show_default=True)
+def main(port, latency, fail_every, organizer, event, items, variations, vouchers, subevents, questions):
+    mock = MockPretix(port=port, latency=latency, fail_every=fail_every)
+    mock.add_event(organizer, generate_event(event, items, variations, vouchers, subevents, questions))
+    print("Serving {}/{} on {} (any Authorization header is accepted)".format(organizer, event, mock.url))
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -3,26 +3,45 @@ import time
 from base64 import b64encode
 from copy import deepcopy
 from json import JSONEncoder
-from bs4 import BeautifulSoup
 
-import requests
 import yaml
-import ruamel.yaml
 import click
 import json
 import collections.abc
+import heapq
+import hashlib
+import pickle
+import random
+import re
+import itertools
+import queue
+from collections import deque
 
-from requests import RequestException
+from urllib.parse import urlsplit
+from threading import Lock, BoundedSemaphore, get_ident
+from contextlib import nullcontext, contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
 
-ref_root = None
+# bs4, requests and ruamel are imported where they are used, so that starting the CLI stays fast
+
+transport = None
+
+_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pretix-steamroller')
 
 class ScalarRef:
-    def __init__(self, v=None, ref=None):
+    __slots__ = ('v', 'ref', 'resolver')
+
+    def __init__(self, v=None, ref=None, resolver=None):
         self.v = v
         self.ref = ref
+        self.resolver = resolver
 
     def deref(self):
-        return _lookup_child(ref_root, self.ref)
+        if not self.ref:
+            return self.v
+        if self.resolver is None:
+            raise RefError("Ref to {} is not bound to an event".format(_format_ref(self.ref)))
+        return self.resolver.resolve(self.ref)
 
     def __repr__(self):
         return "SR:"+str(self.v)
@@ -31,18 +50,116 @@ class ScalarRef:
         return self.v == other.v if isinstance(other, ScalarRef) else self.v == other
 
 
-class MyDumper(yaml.SafeDumper):
-    # HACK: insert blank lines between top-level objects
-    # inspired by https://stackoverflow.com/a/44284819/3786245
-    def write_line_break(self, data=None):
-        super().write_line_break(data)
+# libyaml-backed loader and dumper where available, the pure python ones otherwise
+_YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_YamlDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+class EventDumper(_YamlDumper):
+    pass
+
+class EventLoader(_YamlLoader):
+    pass
+
+EventDumper.add_representer(ScalarRef, lambda dumper, data: dumper.represent_sequence('ref', data.ref, flow_style=True) if data.ref else dumper.represent_data(data.v))
+EventLoader.add_constructor('ref', lambda loader, node: ScalarRef(ref=loader.construct_sequence(node)))
+
+def _encode_ref(obj):
+    if isinstance(obj, ScalarRef):
+        return {'$ref': obj.ref} if obj.ref else obj.v
+    raise TypeError("Object of type {} is not serializable".format(type(obj).__name__))
+
+def _decode_ref(obj):
+    return ScalarRef(ref=obj['$ref']) if len(obj) == 1 and '$ref' in obj else obj
+
+# an event file is written as a sequence of top-level sections, whose values are either complete or an iterator of pages
+class YamlSerializer:
+    extension = '.yml'
+    binary = False
+
+    def __init__(self, dumper=EventDumper, loader=EventLoader):
+        self.dumper = dumper
+        self.loader = loader
+
+    def write(self, f, sections):
+        # one document per section, so sections are separated by blank lines
+        for i, (key, value) in enumerate(sections):
+            if i:
+                f.write('\n')
+            if not isinstance(value, collections.abc.Iterator):
+                yaml.dump({key: value}, f, sort_keys=False, Dumper=self.dumper)
+                continue
+            empty = True
+            for page in value:
+                if empty:
+                    f.write(key + ':\n')
+                    empty = False
+                yaml.dump(page, f, sort_keys=False, Dumper=self.dumper)
+            if empty:
+                f.write(key + ': []\n')
+
+    def read(self, f):
+        return yaml.load(f, Loader=self.loader)
+
+    def check(self):
+        pass
+
+class JsonSerializer:
+    extension = '.json'
+    binary = False
+
+    def write(self, f, sections):
+        f.write('{')
+        for i, (key, value) in enumerate(sections):
+            f.write(',\n' if i else '\n')
+            f.write(json.dumps(key) + ': ')
+            if not isinstance(value, collections.abc.Iterator):
+                f.write(json.dumps(value, default=_encode_ref))
+                continue
+            f.write('[')
+            for j, obj in enumerate(obj for page in value for obj in page):
+                if j:
+                    f.write(', ')
+                f.write(json.dumps(obj, default=_encode_ref))
+            f.write(']')
+        f.write('\n}\n')
+
+    def read(self, f):
+        return json.load(f, object_hook=_decode_ref)
+
+    def check(self):
+        pass
+
+def _import_msgpack():
+    try:
+        import msgpack
+    except ImportError:
+        raise click.ClickException("The msgpack format needs the msgpack package: pip install msgpack")
+    return msgpack
+
+class MsgpackSerializer:
+    extension = '.msgpack'
+    binary = True
+
+    def write(self, f, sections):
+        msgpack = _import_msgpack()
+        # msgpack needs the length of an array up front, so streamed sections are collected first
+        data = {key: [obj for page in value for obj in page] if isinstance(value, collections.abc.Iterator) else value for key, value in sections}
+        msgpack.pack(data, f, default=_encode_ref)
 
-        if len(self.indents) == 1:
-            super().write_line_break()
+    def read(self, f):
+        msgpack = _import_msgpack()
+        return msgpack.unpack(f, object_hook=_decode_ref, raw=False, strict_map_key=False)
 
-MyDumper.add_representer(ScalarRef, lambda dumper, data: dumper.represent_sequence('ref', data.ref, flow_style=True) if data.ref else dumper.represent_data(data.v))
+    def check(self):
+        _import_msgpack()
 
-yaml.SafeLoader.add_constructor('ref', lambda loader, node: ScalarRef(ref=loader.construct_sequence(node)))
+_SERIALIZERS = {'yaml': YamlSerializer(), 'json': JsonSerializer(), 'msgpack': MsgpackSerializer()}
+
+def _serializer_for(filename, format=None):
+    if format:
+        return _SERIALIZERS[format]
+    ext = os.path.splitext(filename)[1]
+    return next((s for s in _SERIALIZERS.values() if s.extension == ext), _SERIALIZERS['yaml'])
 
 
 class SRJSONEncoder(JSONEncoder):
@@ -51,15 +168,451 @@ class SRJSONEncoder(JSONEncoder):
             return obj.deref()
         return super().default(obj)
 
-def _print_request_error(e: RequestException):
-    print("Error: ", str(e))
-    print("URL:   ", e.request.method, e.request.url)
-    if hasattr(e.request, 'data'): print("Sent:  ", e.request.data)
-    print("Got:   ", e.response.status_code, e.response.text)
+def _print_request_error(e):
+    _print_error_block(e, e.request.method, e.request.url, getattr(e.request, 'data', None), e.response)
+
+_print_lock = Lock()
+
+def _print_error_block(e, method, url, sent=None, res=None):
+    # printed under a lock, so that errors of requests running in parallel do not end up interleaved
+    lines = ["Error:  " + str(e), "URL:    {} {}".format(method, url)]
+    if sent is not None: lines.append("Sent:   {}".format(sent))
+    if res is not None: lines.append("Got:    {} {}".format(res.status_code, res.text))
+    with _print_lock:
+        print("\n".join(lines), flush=True)
+
+# persistent store for GET responses, keyed by URL and credentials. Entries older than the ttl are revalidated
+# with ETag/Last-Modified, the least recently used ones are evicted once the cache grows beyond max_size bytes.
+class ResponseCache:
+    def __init__(self, directory, ttl=0, max_size=512 * 1024 * 1024):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = None
+        self._total = 0
+        self._lock = Lock()
+
+    def key(self, url, params, headers):
+        scope = hashlib.sha256((headers or {}).get('Authorization', '').encode('utf-8')).hexdigest()
+        return hashlib.sha256(json.dumps([url, sorted((params or {}).items()), scope]).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _index(self):
+        # size and last use of every entry, read from disk once
+        if self._entries is None:
+            self._entries = {}
+            for root, dirs, files in os.walk(self.directory):
+                if root == self.directory:
+                    # entries live in subdirectories named after the first two characters of their key
+                    dirs[:] = [d for d in dirs if len(d) == 2]
+                    continue
+                for name in files:
+                    if not name.endswith('.tmp'):
+                        stat = os.stat(os.path.join(root, name))
+                        self._entries[name] = (stat.st_size, stat.st_mtime)
+            self._total = sum(size for size, _ in self._entries.values())
+        return self._entries
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                entry = pickle.load(f)
+            # the modification time doubles as last use, so the LRU order survives restarts
+            os.utime(self._path(key))
+        except (OSError, pickle.PickleError, EOFError):
+            return None
+        with self._lock:
+            if key in self._index():
+                self._entries[key] = (self._entries[key][0], time.time())
+        return entry
+
+    def put(self, key, entry):
+        path = self._path(key)
+        tmp = '{}.{}.tmp'.format(path, get_ident())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, 'wb') as f:
+            pickle.dump(entry, f)
+            size = f.tell()
+        os.replace(tmp, path)
+        with self._lock:
+            old = self._index().get(key)
+            self._entries[key] = (size, time.time())
+            self._total += size - (old[0] if old else 0)
+            if self._total <= self.max_size:
+                return
+            # evicting a tenth more than needed keeps the next puts from sorting the index again
+            for victim, (size, _) in sorted(self._entries.items(), key=lambda e: e[1][1]):
+                if self._total <= self.max_size * 0.9:
+                    break
+                try:
+                    os.remove(self._path(victim))
+                except OSError:
+                    pass
+                del self._entries[victim]
+                self._total -= size
+
+    @staticmethod
+    def entry(res):
+        from requests.structures import CaseInsensitiveDict
+        return {'url': res.url, 'headers': CaseInsensitiveDict(res.headers), 'content': res.content, 'encoding': res.encoding, 'stored': time.time()}
+
+    @staticmethod
+    def response(entry):
+        import requests
+        from requests.structures import CaseInsensitiveDict
+        res = requests.Response()
+        res.status_code = 200
+        res.url = entry['url']
+        res.headers = CaseInsensitiveDict(entry['headers'])
+        res.encoding = entry['encoding']
+        res._content = entry['content']
+        return res
+
+
+# token bucket allowing `rate` requests per second on average and bursts of up to `burst` requests
+class RateLimiter:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # the token is taken right away, callers that went into debt wait until it is paid back
+            self._tokens -= 1
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+    def pause(self, delay):
+        # the server asked us to back off, so every caller waits
+        with self._lock:
+            self._tokens = min(self._tokens, -delay * self.rate)
+
+
+# upper bounds in ms of the latency histogram buckets
+_LATENCY_BUCKETS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf')]
+
+class Tracer:
+    # collects timings of API requests and of the phases of a command, and passes each of them on to the hooks
+    def __init__(self):
+        self.hooks = []
+        self.origin = time.perf_counter()
+        self._requests = {}
+        self._phases = {}
+        self._lock = Lock()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def emit(self, event):
+        for hook in self.hooks:
+            hook(event)
+
+    def record_request(self, method, endpoint, url, start, duration, status=None, error=None, sent=0, received=0, retries=0, cache=None):
+        name = method + ' ' + endpoint
+        with self._lock:
+            stats = self._requests.setdefault(name, {'count': 0, 'errors': 0, 'retries': 0, 'cached': 0, 'sent': 0, 'received': 0, 'durations': []})
+            stats['count'] += 1
+            stats['errors'] += bool(error or status is None or status >= 400)
+            stats['retries'] += retries
+            stats['cached'] += cache is not None
+            stats['sent'] += sent
+            stats['received'] += received
+            stats['durations'].append(duration)
+        if self.hooks:
+            self.emit({'type': 'request', 'name': name, 'url': url, 'start': start - self.origin, 'duration': duration, 'thread': get_ident(),
+                       'status': status, 'error': error, 'sent': sent, 'received': received, 'retries': retries, 'cache': cache})
+
+    @contextmanager
+    def phase(self, name, **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            with self._lock:
+                stats = self._phases.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0})
+                stats['count'] += 1
+                stats['total'] += duration
+                stats['max'] = max(stats['max'], duration)
+            if self.hooks:
+                self.emit({'type': 'phase', 'name': name, 'start': start - self.origin, 'duration': duration, 'thread': get_ident(), 'args': args})
+
+    def aggregate(self):
+        with self._lock:
+            requests = {}
+            for name, stats in self._requests.items():
+                durations = sorted(stats['durations'])
+                histogram = [0] * len(_LATENCY_BUCKETS)
+                for d in durations:
+                    histogram[next(i for i, bound in enumerate(_LATENCY_BUCKETS) if d * 1000 <= bound)] += 1
+                requests[name] = {**{k: v for k, v in stats.items() if k != 'durations'},
+                                  'total': sum(durations), 'p50': durations[len(durations) // 2], 'p95': durations[int(len(durations) * 0.95)],
+                                  'max': durations[-1], 'histogram': dict(zip(map(str, _LATENCY_BUCKETS), histogram))}
+            return {'requests': requests, 'phases': {name: dict(stats) for name, stats in self._phases.items()}}
+
+    def close(self):
+        if self.hooks:
+            self.emit({'type': 'summary', **self.aggregate()})
+
+    def summary(self):
+        stats = self.aggregate()
+        lines = ["{:<64} {:>6} {:>5} {:>5} {:>8} {:>8} {:>8} {:>9} {:>9}".format('request', 'count', 'err', 'retry', 'p50', 'p95', 'max', 'sent', 'received')]
+        for name, r in sorted(stats['requests'].items(), key=lambda item: -item[1]['total']):
+            lines.append("{:<64} {:>6} {:>5} {:>5} {:>7.0f}ms {:>6.0f}ms {:>6.0f}ms {:>8.0f}k {:>8.0f}k".format(
+                name[:64], r['count'], r['errors'], r['retries'], r['p50'] * 1000, r['p95'] * 1000, r['max'] * 1000, r['sent'] / 1024, r['received'] / 1024))
+        if stats['phases']:
+            lines.append("")
+            lines.append("{:<64} {:>6} {:>9} {:>9}".format('phase', 'count', 'total', 'max'))
+            for name, p in sorted(stats['phases'].items(), key=lambda item: -item[1]['total']):
+                lines.append("{:<64} {:>6} {:>8.2f}s {:>8.2f}s".format(name[:64], p['count'], p['total'], p['max']))
+        return "\n".join(lines)
+
+class JsonLinesTraceWriter:
+    def __init__(self, f):
+        self.f = f
+        self._lock = Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event, default=str)
+        with self._lock:
+            self.f.write(line + '\n')
+
+# writes the Trace Event Format understood by chrome://tracing and Perfetto
+class ChromeTraceWriter:
+    def __init__(self, f):
+        self.f = f
+        self._lock = Lock()
+        self._first = True
+        self.f.write('[')
+
+    def __call__(self, event):
+        if event['type'] == 'summary':
+            return
+        args = event['args'] if event['type'] == 'phase' else {k: v for k, v in event.items() if k not in ('type', 'name', 'start', 'duration', 'thread')}
+        line = json.dumps({'name': event['name'], 'cat': event['type'], 'ph': 'X', 'pid': os.getpid(), 'tid': event['thread'],
+                           'ts': event['start'] * 1e6, 'dur': event['duration'] * 1e6, 'args': args}, default=str)
+        with self._lock:
+            self.f.write(('\n' if self._first else ',\n') + line)
+            self._first = False
+
+    def close(self):
+        self.f.write('\n]\n')
+
+_TRACE_WRITERS = {'jsonl': JsonLinesTraceWriter, 'chrome': ChromeTraceWriter}
+
+tracer = Tracer()
+
+# one pooled keep-alive session per host, shared by every APILink derived from the same root link.
+# failed requests are retried with jittered exponential backoff, honoring Retry-After. Methods that are
+# not idempotent are only retried on 429, which pretix sends before doing anything.
+class Transport:
+    retry_status = {429, 500, 502, 503, 504}
+    retry_methods = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+
+    def __init__(self, pool_size=10, timeout=(10, 60), cache=None, max_per_host=None, max_retries=5, backoff=0.5, max_backoff=60, rate=None,
+                 tracer=None):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.cache = cache
+        self.max_per_host = max_per_host
+        self.max_jobs = None
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.rate = rate
+        self.tracer = tracer
+        self._sessions = {}
+        self._slots = {}
+        self._limiters = {}
+        self._lock = Lock()
+
+    def session(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._sessions:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[host] = session
+            return self._sessions[host]
+
+    def limit_jobs(self, jobs):
+        # the --jobs of a command. Its pools are nested, e.g. a page pool within a collection pool, so the
+        # number of workers alone does not bound the number of requests in flight
+        with self._lock:
+            self.max_jobs = jobs
+            self._slots = {}
+
+    def slot(self, url):
+        # limits the number of requests in flight per host, no matter how many workers share this transport
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._slots:
+                limit = min(filter(None, (self.max_per_host, self.max_jobs)), default=None)
+                self._slots[host] = BoundedSemaphore(limit) if limit else nullcontext()
+            return self._slots[host]
+
+    def limiter(self, url):
+        # pretix enforces its rate limits per organizer, so do we
+        parts = urlsplit(url)
+        organizer = re.match(r'/(?:api/v1/organizers|control/event)/([^/]+)', parts.path)
+        key = (parts.netloc, organizer and organizer.group(1))
+        with self._lock:
+            if key not in self._limiters:
+                self._limiters[key] = RateLimiter(self.rate) if self.rate else None
+            return self._limiters[key]
+
+    def request(self, method, url, endpoint=None, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        if self.tracer is None:
+            return self._request(method, url, {}, **kwargs)
+        stats = {'retries': 0, 'cache': None}
+        start = time.perf_counter()
+        try:
+            res = self._request(method, url, stats, **kwargs)
+        except Exception as e:
+            self.tracer.record_request(method, endpoint or urlsplit(url).path, url, start, time.perf_counter() - start,
+                                       error=type(e).__name__, retries=stats['retries'])
+            raise
+        data = kwargs.get('data')
+        self.tracer.record_request(method, endpoint or urlsplit(url).path, url, start, time.perf_counter() - start, res.status_code,
+                                   sent=len(data) if isinstance(data, (str, bytes)) else 0,
+                                   received=int(res.headers.get('Content-Length') or len(res.content)) if stats['cache'] is None else 0,
+                                   retries=stats['retries'], cache=stats['cache'])
+        return res
+
+    def _request(self, method, url, stats, **kwargs):
+        if method != 'GET' or self.cache is None:
+            return self._send(method, url, stats, **kwargs)
+        return self._cached_get(url, stats, **kwargs)
+
+    def _send(self, method, url, stats, **kwargs):
+        import requests
+        limiter = self.limiter(url)
+        # whether an earlier attempt may have reached the server although its response was lost or an error
+        maybe_applied = False
+        for attempt in itertools.count():
+            stats['retries'] = attempt
+            if limiter:
+                limiter.acquire()
+            try:
+                with self.slot(url):
+                    res = self.session(url).request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.max_retries or method not in self.retry_methods:
+                    raise
+                delay = self._backoff(attempt)
+                maybe_applied = True
+            else:
+                if method == 'DELETE' and maybe_applied and res.status_code == 404:
+                    # the object is gone, most likely through the attempt we did not get an answer for
+                    res.status_code = 204
+                    return res
+                maybe_applied = maybe_applied or res.status_code != 429
+                if (attempt >= self.max_retries or res.status_code not in self.retry_status
+                        or (method not in self.retry_methods and res.status_code != 429)):
+                    return res
+                delay = self._retry_after(res)
+                if delay is None:
+                    delay = self._backoff(attempt)
+                elif limiter:
+                    limiter.pause(delay)
+            time.sleep(delay)
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def _retry_after(self, res):
+        value = res.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return min(self.max_backoff, max(0.0, float(value)))
+        except ValueError:
+            pass
+        # only HTTP-date values need the email package, which is slow to import
+        from email.utils import parsedate_to_datetime
+        try:
+            return min(self.max_backoff, max(0.0, parsedate_to_datetime(value).timestamp() - time.time()))
+        except (TypeError, ValueError):
+            return None
+
+    def _cached_get(self, url, stats, headers=None, params=None, **kwargs):
+        key = self.cache.key(url, params, headers)
+        entry = self.cache.get(key)
+        if entry and time.time() - entry['stored'] < self.cache.ttl:
+            stats['cache'] = 'hit'
+            return self.cache.response(entry)
+        headers = dict(headers or {})
+        if entry:
+            from requests.structures import CaseInsensitiveDict
+            entry['headers'] = CaseInsensitiveDict(entry['headers'])
+        if entry and 'ETag' in entry['headers']:
+            headers['If-None-Match'] = entry['headers']['ETag']
+        if entry and 'Last-Modified' in entry['headers']:
+            headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+        res = self._send('GET', url, stats, headers=headers, params=params, **kwargs)
+        if res.status_code == 304 and entry:
+            stats['cache'] = 'revalidated'
+            entry['stored'] = time.time()
+            entry['headers'].update((name, res.headers[name]) for name in ('ETag', 'Last-Modified') if name in res.headers)
+            self.cache.put(key, entry)
+            return self.cache.response(entry)
+        if res.status_code == 200 and (self.cache.ttl or 'ETag' in res.headers or 'Last-Modified' in res.headers):
+            self.cache.put(key, self.cache.entry(res))
+        return res
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+
+# auth headers per API base URL or base URL/organizer, read from auth.yml on first use.
+# PRETIX_TOKEN overrides the file with a token for every server, PRETIX_AUTH_FILE points to another file
+class CredentialProvider:
+    def __init__(self, filename=None, environ=os.environ):
+        self.filename = filename or environ.get('PRETIX_AUTH_FILE', 'auth.yml')
+        self.token = environ.get('PRETIX_TOKEN')
+        self._headers = None
+        self._lock = Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._headers is None:
+                try:
+                    with open(self.filename, 'r') as f:
+                        self._headers = yaml.load(f, Loader=_YamlLoader) or {}
+                except FileNotFoundError:
+                    self._headers = {}
+            return self._headers
+
+    def __getitem__(self, key):
+        if self.token:
+            return {'Authorization': 'Token ' + self.token}
+        headers = self._load()
+        if key not in headers:
+            raise click.ClickException("No credentials for {} in {}, and PRETIX_TOKEN is not set".format(key, self.filename))
+        return headers[key]
+
+credentials = CredentialProvider()
 
 class APILink:
     link_format = "{}/api/v1/{}/"
-    def __init__(self, api_base, headers, path=[], vars={}):
+    def __init__(self, api_base, headers, path=[], vars={}, transport=None):
         if not api_base.startswith("http:") and not api_base.startswith("https:"):
             if api_base.startswith("localhost:"):
                 api_base = "http://" + api_base
@@ -69,6 +622,7 @@ class APILink:
         self._headers = headers
         self.path = path
         self.vars = vars
+        self.transport = transport or Transport()
 
     def __str__(self):
         return self.link_format.format(self.api_base, "/".join(self.fpath))
@@ -77,6 +631,11 @@ class APILink:
     def fpath(self):
         return (el.format(**self.vars) for el in self.path)
 
+    @property
+    def endpoint(self):
+        # the path with placeholders instead of slugs and ids, so requests to the same kind of object are traced together
+        return '/' + '/'.join(self.path)
+
     @property
     def headers(self):
         try:
@@ -92,49 +651,74 @@ class APILink:
             varname, varvalue = other
             vars = dict(**vars, **{varname: varvalue})
             other = ['{' + varname + '}']
-        new = APILink(self.api_base, self._headers, self.path + other, vars)
+        new = APILink(self.api_base, self._headers, self.path + other, vars, self.transport)
         new.link_format = self.link_format
         return new
 
     def __floordiv__(self, other):
-        new = deepcopy(self)
-        new.path = []
+        new = APILink(self.api_base, self._headers, [], self.vars, self.transport)
+        new.link_format = self.link_format
         return new / other
 
     def with_(self, link_format):
-        l = deepcopy(self)
-        l.link_format = '{}/control/{}'
+        l = APILink(self.api_base, self._headers, self.path, self.vars, self.transport)
+        l.link_format = link_format
         return l
 
-    def _do_get_request(self, url=None):
+    def _do_get_request(self, url=None, params=None):
+        from requests import RequestException
+        res = None
         try:
-            res = requests.get(url or self.__str__(), headers=self.headers)
+            res = self.transport.request('GET', url or self.__str__(), self.endpoint, params=params, headers=self.headers)
             res.raise_for_status()
             return res
         except RequestException as e:
-            print("Error: ", str(e))
-            print("URL:   ", 'GET', self.__str__())
-            print("Got:   ", res.status_code, res.text)
+            _print_error_block(e, 'GET', url or self.__str__(), res=res)
             raise
 
     def get_html(self):
+        from bs4 import BeautifulSoup
         return BeautifulSoup(self._do_get_request().text, 'html.parser')
 
     def fetch_single(self):
         return self._do_get_request().json()
 
-    def fetch_all(self):
+    def fetch_all(self, page_size=None, jobs=1, params=None):
         results = []
-        response = self._do_get_request().json()
-        results.extend(response['results'])
-        while response.get('next'):
-            response = self._do_get_request(response['next']).json()
-            results.extend(response['results'])
+        for page in self.iter_pages(page_size, jobs, params):
+            results.extend(page)
         return results
 
+    def iter_pages(self, page_size=None, jobs=1, params=None):
+        # params are filters, which the server repeats in the next links
+        filters = dict(params or {})
+        response = self._do_get_request(params={**filters, 'page_size': page_size} if page_size else filters or None).json()
+        yield response['results']
+        if not response.get('next'):
+            return
+        if not response.get('count') or not response['results']:
+            while response.get('next'):
+                response = self._do_get_request(response['next']).json()
+                yield response['results']
+            return
+        # the first page tells us the total, so the remaining page URLs are known and can be fetched in parallel.
+        # the server may cap page_size, so stick to the size it actually used.
+        per_page = len(response['results'])
+        params = {**filters, 'page_size': per_page} if page_size else filters
+        fetch_page = lambda page: self._do_get_request(params={**params, 'page': page}).json()['results']
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            pending = deque()
+            for page in range(2, -(-response['count'] // per_page) + 1):
+                pending.append(pool.submit(fetch_page, page))
+                if len(pending) > jobs:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
     def _do_form_request(self, method, body):
+        from requests import RequestException
         try:
-            res = requests.request(method, self.__str__(), data=body, headers=self.headers)
+            res = self.transport.request(method, self.__str__(), self.endpoint, data=body, headers=self.headers)
             res.raise_for_status()
             return res.json()
         except RequestException as e:
@@ -142,9 +726,10 @@ class APILink:
             raise
 
     def _do_json_request(self, method, body):
+        from requests import RequestException
         try:
             data = json.dumps(body, cls=SRJSONEncoder)
-            res = requests.request(method, self.__str__(), data=data,
+            res = self.transport.request(method, self.__str__(), self.endpoint, data=data,
                   headers={'Content-Type': 'application/json', 'Accept': 'application/json', **self.headers})
             res.raise_for_status()
             return res.json()
@@ -159,7 +744,7 @@ class APILink:
     def put(self, body):
         return self._do_json_request('PUT', body)
     def delete(self):
-        res = requests.request('DELETE', self.__str__(),
+        res = self.transport.request('DELETE', self.__str__(), self.endpoint,
               headers={'Content-Type': 'application/json', 'Accept': 'application/json', **self.headers})
         res.raise_for_status()
 
@@ -185,77 +770,293 @@ def _deep_update(d, u):
                 d[k] = v
     return d
 
-def _flatten(x):
-    return [el for y in x for el in y]
-
 def _kv(enumerable):
     return enumerable.items() if hasattr(enumerable, 'items') else enumerate(enumerable)
 
-def _lookup_children(obj, path, assign_refs=False, ignore_key_errors=False, with_path=None, delete=False):
-    if isinstance(path, str): path = path.split('.')[1:]
-    if path[0] != '*':
-        ignore_key_errors_local = False
-        if path[0].endswith('?'):
-            path[0] = path[0][:-1]
-            ignore_key_errors_local = True
-        try:
-            child = obj[path[0]]
-        except KeyError:
-            if ignore_key_errors or ignore_key_errors_local:
-                return []
+def _kv_reversed(enumerable):
+    return reversed(enumerable.items()) if hasattr(enumerable, 'items') else zip(range(len(enumerable) - 1, -1, -1), reversed(enumerable))
+
+class PathExpr:
+    # a dotted path like '.items.*.variations?.*.id', parsed once into (key, optional) steps
+    __slots__ = ('path', 'steps', 'keys')
+
+    def __init__(self, path):
+        self.path = path
+        self.steps = tuple((key[:-1], True) if key.endswith('?') else (key, False) for key in path.split('.')[1:])
+        self.keys = [key for key, optional in self.steps]
+
+    def __repr__(self):
+        return 'PathExpr({!r})'.format(self.path)
+
+    def walk(self, obj, assign_refs=False, ignore_key_errors=False, with_path=None, delete=False):
+        steps = self.steps
+        last = len(steps) - 1
+        # explicit stack of (container, step index, path so far), only pushed to when expanding a wildcard
+        stack = [(obj, 0, with_path)]
+        while stack:
+            obj, depth, prefix = stack.pop()
+            key, optional = steps[depth]
+            while key != '*' and depth < last:
+                try:
+                    obj = obj[key]
+                except KeyError:
+                    if ignore_key_errors or optional:
+                        break
+                    raise
+                if prefix is not None: prefix = prefix + [key]
+                depth += 1
+                key, optional = steps[depth]
             else:
-                raise
-        if len(path) == 1:
-            if delete:
-                del obj[path[0]]
-                return []
-            if assign_refs and not isinstance(child, ScalarRef): child = obj[path[0]] = ScalarRef(child)
-            return [(with_path + [path[0]], child)] if with_path is not None else [child]
-        else:
-            return _lookup_children(child, path[1:], assign_refs, ignore_key_errors, with_path + [path[0]] if with_path is not None else None, delete)
-    else:
-        if len(path) == 1:
-            if delete:
-                obj[:] = []
-            if assign_refs:
-                for i, el in _kv(obj):
-                    if not isinstance(el, ScalarRef): obj[i] = ScalarRef(el)
-            return [(with_path + [i], child) for i, child in _kv(obj)] if with_path is not None else obj
-        return _flatten([_lookup_children(x, path[1:], assign_refs, ignore_key_errors, with_path + [i] if with_path is not None else None, delete) for i, x in _kv(obj)])
+                if key != '*':
+                    try:
+                        child = obj[key]
+                    except KeyError:
+                        if ignore_key_errors or optional:
+                            continue
+                        raise
+                    if delete:
+                        del obj[key]
+                        continue
+                    if assign_refs and not isinstance(child, ScalarRef): child = obj[key] = ScalarRef(child)
+                    yield (prefix + [key], child) if prefix is not None else child
+                elif depth == last:
+                    if delete:
+                        obj[:] = []
+                        continue
+                    for i, child in _kv(obj):
+                        if assign_refs and not isinstance(child, ScalarRef): child = obj[i] = ScalarRef(child)
+                        yield (prefix + [i], child) if prefix is not None else child
+                else:
+                    stack.extend((child, depth + 1, prefix + [i] if prefix is not None else None) for i, child in _kv_reversed(obj))
+
+_compiled_paths = {}
+
+def _compile_path(path):
+    if isinstance(path, PathExpr):
+        return path
+    try:
+        return _compiled_paths[path]
+    except KeyError:
+        return _compiled_paths.setdefault(path, PathExpr(path))
+
+def _lookup_children(obj, path, assign_refs=False, ignore_key_errors=False, with_path=None, delete=False):
+    return list(_compile_path(path).walk(obj, assign_refs, ignore_key_errors, with_path, delete))
 
 def _lookup_child(obj, path):
-    if len(path) < 2:
-        return obj[path[0]]
-    return _lookup_child(obj[path[0]], path[1:])
-
-def _fixup_refs(obj, where, to_where, to_what):
-    to_what = to_what.split('.')[1:]
-    to_objs = _lookup_children(obj, to_where, with_path=[])
-    from_obj = _lookup_children(obj, where, assign_refs=True)
-    for from_id in from_obj:
+    for key in path:
+        obj = obj[key]
+    return obj
+
+class RefIndex:
+    # one hash map per (to_where, to_what) target pattern, mapping each target value to the path of its first occurrence
+    def __init__(self, obj):
+        self.obj = obj
+        self._indexes = {}
+
+    def lookup(self, to_where, to_what):
+        key = (to_where, to_what)
+        if key not in self._indexes:
+            self._indexes[key] = self._add({}, self.obj, to_where, to_what)
+        return self._indexes[key]
+
+    def extend(self, to_where, to_what, obj, offset=0):
+        # for targets that arrive page by page: obj holds one page, offset is the number of objects on the pages before
+        return self._add(self._indexes.setdefault((to_where, to_what), {}), obj, to_where, to_what, offset)
+
+    def _add(self, index, obj, to_where, to_what, offset=0):
+        to_what = _compile_path(to_what).keys
+        for path, y in _compile_path(to_where).walk(obj, with_path=[]):
+            try:
+                value = _lookup_child(y, to_what)
+                if offset:
+                    path = [path[0], path[1] + offset] + path[2:]
+                index.setdefault(value.v if isinstance(value, ScalarRef) else value, path + to_what)
+            except (KeyError, IndexError, TypeError):
+                pass
+        return index
+
+    def resolve(self, obj, where, to_where, to_what):
+        index = self.lookup(to_where, to_what)
+        for from_id in _compile_path(where).walk(obj, assign_refs=True):
+            try:
+                path = index.get(from_id.v)
+            except TypeError:
+                continue
+            if path is not None:
+                from_id.ref = list(path)
+
+def _fixup_refs(obj, rules, index=None):
+    index = index or RefIndex(obj)
+    for where, to_where, to_what in rules:
+        index.resolve(obj, where, to_where, to_what)
+
+class RefError(click.ClickException):
+    pass
+
+def _format_ref(path):
+    return '.' + '.'.join(str(key) for key in path)
+
+def _refs_with_path(value, path=()):
+    if isinstance(value, ScalarRef):
+        yield path, value
+    elif isinstance(value, (collections.abc.Mapping, list)):
+        for key, v in _kv(value):
+            yield from _refs_with_path(v, path + (key,))
+
+class RefResolver:
+    # owns the refs of one event document and memoizes what they point at. Objects get new ids when they are
+    # created or matched, so whoever changes ids has to invalidate the object they belong to
+    def __init__(self, root):
+        self.root = root
+        self._memo = {}
+        self._dependents = {}
+        self._generation = 0
+        self._lock = Lock()
+        self.bind(root)
+
+    def bind(self, value):
+        # refs added to the document later have to be bound as well
+        for path, ref in _refs_with_path(value):
+            ref.resolver = self
+
+    def _follow(self, path, hops=None):
+        # refs may point at other refs, the chain ends at the first plain value
+        hops = [] if hops is None else hops
+        while True:
+            if path in hops:
+                raise RefError("Ref cycle: " + " -> ".join(_format_ref(hop) for hop in hops + [path]))
+            hops.append(path)
+            target = _lookup_child(self.root, path)
+            if not isinstance(target, ScalarRef):
+                return target, hops
+            if not target.ref:
+                return target.v, hops
+            path = tuple(target.ref)
+
+    def resolve(self, path):
+        path = tuple(path)
         try:
-            path, ref = next((path, y) for (path, y) in to_objs if _lookup_child(y, to_what) == from_id)
-            from_id.ref = path + to_what
-        except StopIteration:
+            return self._memo[path]
+        except KeyError:
             pass
+        generation = self._generation
+        value, hops = self._follow(path)
+        with self._lock:
+            # something was invalidated meanwhile, so the value may already be outdated
+            if generation == self._generation:
+                self._memo[path] = value
+                for hop in hops:
+                    self._dependents.setdefault(hop[:2], set()).add(path)
+        return value
+
+    def invalidate(self, name=None, index=None):
+        with self._lock:
+            self._generation += 1
+            if name is None:
+                self._memo.clear()
+                self._dependents.clear()
+                return
+            for path in self._dependents.pop((name, index), ()):
+                self._memo.pop(path, None)
+
+    def check(self):
+        # ids of objects that are yet to be created may be missing, anything else has to exist
+        for location, ref in _refs_with_path(self.root):
+            if not ref.ref:
+                continue
+            hops = []
+            try:
+                self._follow(tuple(ref.ref), hops)
+            except (KeyError, IndexError, TypeError):
+                path = hops[-1]
+                try:
+                    pending = path[-1] == 'id' and isinstance(_lookup_child(self.root, path[:-1]), collections.abc.Mapping)
+                except (KeyError, IndexError, TypeError):
+                    pending = False
+                if not pending:
+                    raise RefError("Dangling ref at {} to {}".format(_format_ref(location), _format_ref(path)))
 
 def _without_keys(d, keys):
     return {x: d[x] for x in d if x not in keys}
 
-def _is_dict_subset(subset, superset):
-    if not isinstance(subset, dict) or not isinstance(superset, dict):
-        return False
-    for key, value in subset.items():
-        if superset.get(key) != value:
-            return False
-    return True
-
-def _kill_defaults(obj, default_file):
-    for path, defaults in default_file.items():
-        for victim in _lookup_children(obj, path, ignore_key_errors=True):
-            for key, value in defaults.items():
-                if key in victim and (victim.get(key) == value or _is_dict_subset(victim.get(key), value)):
-                    del victim[key]
+def _freeze(value):
+    if isinstance(value, ScalarRef):
+        return _freeze(value.v)
+    if isinstance(value, dict):
+        return frozenset((key, _freeze(v)) for key, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+_SCALARS = (str, int, float, bool, type(None))
+
+class DefaultsFilter:
+    # default values per path, frozen so that comparing them does not need to walk nested structures twice
+    # bump whenever PathExpr or the layout of the rules changes, so that pickles of older versions are not used
+    CACHE_FORMAT = 1
+
+    def __init__(self, defaults):
+        self.rules = [
+            (_compile_path(path), _section(path), tuple(
+                (key, {k: _freeze(v) for k, v in value.items()} if isinstance(value, dict) else _freeze(value), isinstance(value, dict))
+                for key, value in values.items()))
+            for path, values in defaults.items()
+        ]
+
+    @classmethod
+    def load(cls, filename, cache_dir=None):
+        stat = os.stat(filename)
+        version = (cls.CACHE_FORMAT, stat.st_mtime_ns, stat.st_size)
+        # kept apart from the entries of a response cache sharing the directory
+        cache_file = os.path.join(cache_dir, 'defaults', hashlib.sha256(os.path.abspath(filename).encode('utf-8')).hexdigest()[:16] + '.pickle') if cache_dir else None
+        if cache_file:
+            try:
+                with open(cache_file, 'rb') as f:
+                    cached_version, rules = pickle.load(f)
+                if cached_version == version:
+                    self = cls.__new__(cls)
+                    self.rules = rules
+                    return self
+            except Exception:
+                # a pickle written by another version of this script may fail in any number of ways
+                pass
+        with open(filename, 'r') as f:
+            self = cls(yaml.load(f, Loader=_YamlLoader))
+        if cache_file:
+            try:
+                os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+                with open(cache_file + '.tmp', 'wb') as f:
+                    pickle.dump((version, self.rules), f, pickle.HIGHEST_PROTOCOL)
+                os.replace(cache_file + '.tmp', cache_file)
+            except OSError:
+                pass
+        return self
+
+    def apply(self, obj, sections=None):
+        for path, section, defaults in self.rules:
+            if sections is not None and section not in sections:
+                continue
+            for victim in path.walk(obj, ignore_key_errors=True):
+                for key, default, is_dict in defaults:
+                    if key not in victim:
+                        continue
+                    value = victim[key]
+                    if is_dict:
+                        # a dict is default if all of its entries are, e.g. a subset of the default translations
+                        if isinstance(value, dict) and all(default.get(k) == (v if type(v) in _SCALARS else _freeze(v)) for k, v in value.items()):
+                            del victim[key]
+                    elif (value if type(value) in _SCALARS else _freeze(value)) == default:
+                        del victim[key]
+
+_defaults_filters = {}
+_defaults_lock = Lock()
+
+def _load_defaults(filename='defaults.yml', cache_dir=_CACHE_DIR):
+    # parsed once per process, and only re-parsed from yaml when the file changed since the last run
+    with _defaults_lock:
+        if filename not in _defaults_filters:
+            _defaults_filters[filename] = DefaultsFilter.load(filename, cache_dir)
+        return _defaults_filters[filename]
 
 def _extract_form_value(form, filter_keys={'csrfmiddlewaretoken'}):
     return {**{
@@ -269,97 +1070,308 @@ def _extract_form_value(form, filter_keys={'csrfmiddlewaretoken'}):
         for i in form.find_all("select") if not i.attrs['name'] in filter_keys
     }}
 
-def _fetch_event_data(apiref):
-    result = {
-        'event': apiref.fetch_single(),
-        'settings': (apiref / 'settings').fetch_single(),
-        'taxrules': (apiref / 'taxrules').fetch_all(),
-        'categories': (apiref / 'categories').fetch_all(),
-        'items': (apiref / 'items').fetch_all(),
-        'quotas': (apiref / 'quotas').fetch_all(),
-        'item_meta_properties': (apiref / 'item_meta_properties').fetch_all(),
-        'questions': (apiref / 'questions').fetch_all(),
-        'vouchers': (apiref / 'vouchers').fetch_all(),
-        'discounts': (apiref / 'discounts').fetch_all(),
-    }
+# subevents are only fetched for event series. They come after the items their prices override and before their quotas
+_EVENT_COLLECTIONS = ['taxrules', 'categories', 'items', 'subevents', 'quotas', 'item_meta_properties', 'questions', 'vouchers', 'discounts']
+
+# collections which can grow to tens of thousands of entries. Refs into them are resolved while they are written
+_STREAMED_COLLECTIONS = ['vouchers', 'subevents']
+
+# collections whose objects may belong to a single subevent
+_SUBEVENT_BOUND = ['quotas', 'vouchers']
+
+_REF_RULES = [
+    ('.items.*.category', '.categories.*', '.id'),
+    ('.items.*.addons.*.addon_category', '.categories.*', '.id'),
+    ('.items.*.tax_rule?', '.taxrules.*', '.id'),
+    ('.items.*.bundles?.*.bundled_item', '.items.*', '.id'),
+    ('.items.*.bundles?.*.bundled_variation', '.items.*.variations.*', '.id'),
+    ('.items.*.hidden_if_available?', '.quotas.*', '.id'),
+    ('.items.*.hidden_if_item_available?', '.items.*', '.id'),
+    ('.quotas.*.items.*', '.items.*', '.id'),
+    ('.quotas.*.variations.*', '.items.*.variations.*', '.id'),
+    ('.vouchers.*.item', '.items.*', '.id'),
+    ('.vouchers.*.variation', '.items.*.variations.*', '.id'),
+    ('.vouchers.*.quota?', '.quotas.*', '.id'),
+    ('.questions.*.items.*', '.items.*', '.id'),
+    ('.questions.*.dependency_question', '.questions.*', '.id'),
+    ('.categories.*.cross_selling_match_products?.*', '.items.*', '.id'),
+    ('.event.seat_category_mapping.*', '.items.*', '.id'),
+    ('.discounts.*.condition_limit_products.*', '.items.*', '.id'),
+    ('.discounts.*.benefit_limit_products.*', '.items.*', '.id'),
+    ('.subevents.*.item_price_overrides.*.item', '.items.*', '.id'),
+    ('.subevents.*.variation_price_overrides.*.variation', '.items.*.variations.*', '.id'),
+    ('.subevents.*.seat_category_mapping?.*', '.items.*', '.id'),
+    ('.quotas.*.subevent', '.subevents.*', '.id'),
+    ('.vouchers.*.subevent', '.subevents.*', '.id'),
+]
+
+_ID_PATHS = [
+    '.categories.*.id',
+    '.item_meta_properties.*.id',
+    '.items.*.id',
+    '.items.*.variations?.*.id',
+    '.questions.*.id',
+    '.vouchers.*.id',
+    '.taxrules.*.id',
+    '.quotas.*.id',
+    '.discounts.*.id',
+    '.subevents?.*.id',
+]
+
+def _section(path):
+    return _compile_path(path).keys[0]
+
+def _subevent_params(after=None, before=None):
+    return {key: value for key, value in (('date_from_after', after), ('date_from_before', before)) if value}
+
+def _drop_other_subevents(objects, subevent_ids):
+    # with a date range, objects of subevents outside of it would be left with ids that do not resolve
+    return [obj for obj in objects if obj.get('subevent') is None or obj['subevent'] in subevent_ids]
+
+def _fetch_event_data(apiref, jobs=1, page_size=None, stream=(), subevent_params=None):
     payment_ref = apiref.with_(link_format='{}/control/{}') // 'event' / '{organizer}' / '{event}' / 'settings' / 'payment'
-    payment_html = payment_ref.get_html()
-    try:
-        payment_links = payment_html.find(class_='table-payment-providers').find_all("a")
-        providers = [l.attrs['href'].split("/settings/payment/")[1] for l in payment_links]
-        result['payment_providers'] = {
-            key: _extract_form_value((payment_ref / ('provider', key)).get_html().find(class_='form-plugins'))
-            for key in providers
+    # streamed collections are returned as lazy page iterators and only fetched while they are written out
+    fetch = lambda name, params=None: ((apiref / name).iter_pages(page_size, jobs, params) if name in stream
+                                       else pool.submit((apiref / name).fetch_all, page_size, jobs, params))
+    # fetched before anything else, so that a wrong slug or a missing permission fails once instead of in every request
+    event_data = apiref.fetch_single()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {
+            'settings': pool.submit((apiref / 'settings').fetch_single),
+            **{name: fetch(name) for name in _EVENT_COLLECTIONS if name != 'subevents'},
         }
-    except:
-        print("Failed to load payment provider info")
-    _fixup_refs(result, '.items.*.category', '.categories.*', '.id')
-    _fixup_refs(result, '.items.*.addons.*.addon_category', '.categories.*', '.id')
-    _fixup_refs(result, '.quotas.*.items.*', '.items.*', '.id')
-    _fixup_refs(result, '.quotas.*.variations.*', '.items.*.variations.*', '.id')
-    _fixup_refs(result, '.vouchers.*.item', '.items.*', '.id')
-    _fixup_refs(result, '.vouchers.*.variation', '.items.*.variations.*', '.id')
-    _fixup_refs(result, '.questions.*.items.*', '.items.*', '.id')
-    _fixup_refs(result, '.questions.*.dependency_question', '.questions.*', '.id')
-    _fixup_refs(result, '.categories.*.cross_selling_match_products?.*', '.items.*', '.id')
-    _fixup_refs(result, '.event.seat_category_mapping.*', '.items.*', '.id')
-    _fixup_refs(result, '.discounts.*.condition_limit_products.*', '.items.*', '.id')
-    _fixup_refs(result, '.discounts.*.benefit_limit_products.*', '.items.*', '.id')
-
-    if result['event']['has_subevents']:
-        result['subevents'] = (apiref / 'subevents').fetch_all()
+        payment_html = pool.submit(payment_ref.get_html)
+        if event_data['has_subevents']:
+            futures['subevents'] = fetch('subevents', subevent_params)
+        # assemble in a fixed order, so the output does not depend on which request finished first
+        try:
+            result = {'event': event_data, **{key: futures[key].result() if key not in stream else futures[key]
+                                              for key in ['settings', *_EVENT_COLLECTIONS] if key in futures}}
+        except BaseException:
+            # requests which did not start yet would most likely fail the same way
+            for key, future in futures.items():
+                if key not in stream:
+                    future.cancel()
+            payment_html.cancel()
+            raise
+        payment_html = payment_html.result()
+        try:
+            payment_links = payment_html.find(class_='table-payment-providers').find_all("a")
+            providers = [l.attrs['href'].split("/settings/payment/")[1] for l in payment_links]
+            provider_html = {key: pool.submit((payment_ref / ('provider', key)).get_html) for key in providers}
+            result['payment_providers'] = {
+                key: _extract_form_value(html.result().find(class_='form-plugins'))
+                for key, html in provider_html.items()
+            }
+        except:
+            print("Failed to load payment provider info")
+    if 'subevents' in result and 'subevents' not in stream:
+        subevent_ids = {subevent['id'] for subevent in result['subevents']}
+        for name in _SUBEVENT_BOUND:
+            if name not in stream:
+                result[name] = _drop_other_subevents(result[name], subevent_ids)
+    with tracer.phase('fixup refs'):
+        # refs from and into streamed collections are resolved when they are written
+        _fixup_refs(result, [rule for rule in _REF_RULES if _section(rule[0]) in result and _section(rule[1]) in result
+                             and _section(rule[0]) not in stream and _section(rule[1]) not in stream])
     return result
 
+def _strip_event_data(result, defaults, keep_ids, sections=None):
+    if defaults:
+        with tracer.phase('filter defaults'):
+            defaults.apply(result, sections)
+    _lookup_children(result, '.event.item_meta_properties', delete=True, ignore_key_errors=True)
+    if not keep_ids:
+        with tracer.phase('filter ids'):
+            for path in _ID_PATHS:
+                if sections is None or _section(path) in sections:
+                    _lookup_children(result, path, delete=True)
+
+def _write_event_stream(f, result, defaults, keep_ids, serializer):
+    stream = [key for key, value in result.items() if isinstance(value, collections.abc.Iterator)]
+    rules = [rule for rule in _REF_RULES if _section(rule[0]) in result and _section(rule[1]) in result]
+    # keep a copy of the reference targets around, as their ids may be stripped before the streamed sections are written
+    ref_index = RefIndex(deepcopy({_section(to_where): result[_section(to_where)] for where, to_where, _ in rules
+                                   if _section(where) in stream and _section(to_where) not in stream}))
+    # streamed targets are indexed page by page, and sections with refs into them have to wait until they are written
+    targets = {key: list(dict.fromkeys((to_where, to_what) for where, to_where, to_what in rules if _section(to_where) == key)) for key in stream}
+    for key in stream:
+        for to_where, to_what in targets[key]:
+            ref_index.extend(to_where, to_what, {key: []})
+    deferred = {_section(where) for where, to_where, _ in rules if _section(to_where) in stream and _section(where) not in stream}
+    _strip_event_data(result, defaults, keep_ids, sections=[key for key in result if key not in stream and key not in deferred])
+
+    def drop_other_subevents(key, objects):
+        if key in _SUBEVENT_BOUND and 'subevents' in stream:
+            return _drop_other_subevents(objects, ref_index.lookup('.subevents.*', '.id'))
+        return objects
+
+    def pages(key, value):
+        offset = 0
+        for page in value:
+            for to_where, to_what in targets[key]:
+                ref_index.extend(to_where, to_what, {key: page}, offset)
+            offset += len(page)
+            page = drop_other_subevents(key, page)
+            if not page:
+                continue
+            with tracer.phase('fixup refs'):
+                _fixup_refs({key: page}, [rule for rule in rules if _section(rule[0]) == key], ref_index)
+            _strip_event_data({key: page}, defaults, keep_ids, sections=[key])
+            yield page
+
+    def sections():
+        for key, value in result.items():
+            if key in stream:
+                value = pages(key, value)
+            elif key in deferred:
+                value = drop_other_subevents(key, value)
+                with tracer.phase('fixup refs'):
+                    _fixup_refs({key: value}, [rule for rule in rules if _section(rule[0]) == key and _section(rule[1]) in stream], ref_index)
+                _strip_event_data({key: value}, defaults, keep_ids, sections=[key])
+            yield key, value
+
+    serializer.write(f, sections())
+
 def maybeextendbasename(fn, extend):
     if not fn: return fn
-    base, ext = os.path.splitext()
+    base, ext = os.path.splitext(fn)
     return base + extend + ext
 
-def _fetch_event_to_file(base, organizer, event, file=None, keep_defaults=False, keep_ids=True):
-    apiref = APILink(base, auth_headers)
+def _event_filename(eventref, file=None, extension='.yml'):
+    return file or ('_'.join(eventref.fpath) + extension)
+
+def _sweep_targets(apiref, organizer, event, file, jobs=1, extension='.yml'):
     if organizer == '*':
-        organizers = apiref / 'organizers'
-        for org in organizers.fetch_all():
-            _fetch_event_to_file(base, org['slug'], event, maybeextendbasename(file, '_organizers_' + org['slug']), keep_defaults, keep_ids)
-        return
-    orgref = apiref / 'organizers' / ('organizer', organizer)
-    if event == '*':
-        events = orgref / 'events'
-        for event in events.fetch_all():
-            print("Fetching event ", organizer, event['slug'])
-            _fetch_event_to_file(base, organizer, event['slug'], maybeextendbasename(file, '_events' + event['slug']), keep_defaults, keep_ids)
+        organizers = [(org['slug'], maybeextendbasename(file, '_organizers_' + org['slug'])) for org in (apiref / 'organizers').fetch_all()]
+    else:
+        organizers = [(organizer, file)]
+    if event != '*':
+        return [(org, event, _event_filename(apiref / 'organizers' / ('organizer', org) / 'events' / ('event', event), fn, extension)) for org, fn in organizers]
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        events = [pool.submit((apiref / 'organizers' / ('organizer', org) / 'events').fetch_all) for org, fn in organizers]
+        return [(org, ev['slug'], _event_filename(apiref / 'organizers' / ('organizer', org) / 'events' / ('event', ev['slug']), maybeextendbasename(fn, '_events' + ev['slug']), extension))
+                for (org, fn), future in zip(organizers, events) for ev in future.result()]
+
+def _run_sweep(targets, fetch, jobs=1, resume=False, max_age=None):
+    def run(organizer, event, filename):
+        # output files are written atomically, so an existing one is always complete
+        if resume and os.path.exists(filename) and (max_age is None or time.time() - os.path.getmtime(filename) < max_age):
+            return None
+        start = time.time()
+        fetch(organizer, event, filename)
+        return time.time() - start
+
+    fetched, skipped, failed = 0, 0, []
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(run, *target): target for target in targets}
+        for i, future in enumerate(as_completed(futures), 1):
+            organizer, event, filename = futures[future]
+            try:
+                duration = future.result()
+            except Exception as e:
+                failed.append((organizer, event))
+                status = "FAILED: {}".format(e)
+            else:
+                if duration is None:
+                    skipped += 1
+                    status = "skipped, {} is current".format(filename)
+                else:
+                    fetched += 1
+                    status = "{} ({:.1f}s)".format(filename, duration)
+            print("[{}/{}] {}/{}: {}".format(i, len(targets), organizer, event, status))
+    print("Fetched {} events, skipped {}, failed {}".format(fetched, skipped, len(failed)))
+    if failed:
+        raise click.ClickException("Failed to fetch " + ", ".join("{}/{}".format(*f) for f in failed))
+
+def _fetch_event_to_file(base, organizer, event, file=None, keep_defaults=False, keep_ids=True, jobs=1, page_size=None, stream=False,
+                         sweep_jobs=1, resume=False, max_age=None, format=None, subevent_params=None, quiet=False, transport=None):
+    # the transport is passed in, so events can be fetched from code other than the CLI
+    transport = transport or Transport()
+    apiref = APILink(base, credentials, transport=transport)
+    extension = _SERIALIZERS[format].extension if format else '.yml'
+    if organizer == '*' or event == '*':
+        # the sweep reports every event on its own progress line
+        fetch = lambda org, ev, fn: _fetch_event_to_file(base, org, ev, fn, keep_defaults, keep_ids, jobs, page_size, stream, format=format,
+                                                            subevent_params=subevent_params, quiet=True, transport=transport)
+        _run_sweep(_sweep_targets(apiref, organizer, event, file, jobs, extension), fetch, sweep_jobs, resume, max_age)
         return
-    eventref = orgref / 'events' / ('event', event)
-    print(eventref)
-    result = _fetch_event_data(eventref)
-    if not keep_defaults:
-        _kill_defaults(result, _read_yaml('defaults.yml'))
-    _lookup_children(result, '.event.item_meta_properties', delete=True, ignore_key_errors=True)
-    if not keep_ids:
-        _lookup_children(result, '.categories.*.id', delete=True)
-        _lookup_children(result, '.item_meta_properties.*.id', delete=True)
-        _lookup_children(result, '.items.*.id', delete=True)
-        _lookup_children(result, '.items.*.variations?.*.id', delete=True)
-        _lookup_children(result, '.questions.*.id', delete=True)
-        _lookup_children(result, '.vouchers.*.id', delete=True)
-        _lookup_children(result, '.taxrules.*.id', delete=True)
-        _lookup_children(result, '.quotas.*.id', delete=True)
-        _lookup_children(result, '.discounts.*.id', delete=True)
-    with open(file or ('_'.join(eventref.fpath) + '.yml'), 'w') as f:
-        yaml.dump(result, f, sort_keys=False, Dumper=MyDumper)
+    eventref = apiref / 'organizers' / ('organizer', organizer) / 'events' / ('event', event)
+    if not quiet:
+        print(eventref)
+    with tracer.phase('load defaults'):
+        # kept next to the cached responses, and not written at all with --no-cache
+        defaults = _load_defaults(cache_dir=transport.cache and transport.cache.directory) if not keep_defaults else None
+    with tracer.phase('fetch', organizer=organizer, event=event):
+        result = _fetch_event_data(eventref, jobs, page_size, _STREAMED_COLLECTIONS if stream else (), subevent_params)
+    filename = _event_filename(eventref, file, extension)
+    serializer = _serializer_for(filename, format)
+    try:
+        with open(filename + '.tmp', 'wb' if serializer.binary else 'w') as f:
+            if stream:
+                # streamed pages are fetched while writing, so this includes their requests
+                with tracer.phase('write', file=filename):
+                    _write_event_stream(f, result, defaults, keep_ids, serializer)
+            else:
+                _strip_event_data(result, defaults, keep_ids)
+                with tracer.phase('write', file=filename):
+                    serializer.write(f, result.items())
+    except BaseException:
+        try:
+            os.remove(filename + '.tmp')
+        except OSError:
+            pass
+        raise
+    os.replace(filename + '.tmp', filename)
 
 def _read_yaml(filename):
+    import ruamel.yaml
     with open(filename, 'r') as f:
         return ruamel.yaml.YAML().load(f)
 
+def _read_event_file(filename):
+    serializer = _serializer_for(filename)
+    with open(filename, 'rb' if serializer.binary else 'r') as f:
+        return serializer.read(f)
+
 def _write_yaml(filename, data):
+    import ruamel.yaml
     with open(filename, 'w') as f:
         ruamel.yaml.YAML().dump(data, f)
 
 
 @click.group()
-def cli():
-    pass
+@click.option('--pool-size', default=10, show_default=True, help='Max. keep-alive connections per host')
+@click.option('--timeout', default=60.0, show_default=True, help='Read timeout per request in seconds')
+@click.option('--max-per-host', type=int, help='Max. concurrent requests per host')
+@click.option('--max-retries', default=5, show_default=True, help='Retries of requests failing with 429, 5xx or connection errors')
+@click.option('--rate', type=float, help='Max. requests per second per host and organizer')
+@click.option('--trace', 'trace_file', type=click.File('w'), help='Write every request and phase with its timing to this file')
+@click.option('--trace-format', type=click.Choice(list(_TRACE_WRITERS)), default='jsonl', show_default=True,
+              help='JSON lines, or the trace event format of chrome://tracing and Perfetto')
+@click.option('--trace-hook', multiple=True, help='module:function to call with every trace event, e.g. to forward them to a metrics system')
+@click.option('--stats', is_flag=True, help='Print a summary of request and phase timings at the end')
+@click.pass_context
+def cli(ctx, pool_size, timeout, max_per_host, max_retries, rate, trace_file=None, trace_format='jsonl', trace_hook=(), stats=False):
+    global transport
+    transport = Transport(pool_size=pool_size, timeout=(10, timeout), max_per_host=max_per_host, max_retries=max_retries, rate=rate,
+                          tracer=tracer)
+    writer = _TRACE_WRITERS[trace_format](trace_file) if trace_file else None
+    if writer:
+        tracer.add_hook(writer)
+    for hook in trace_hook:
+        import importlib
+        module, _, name = hook.partition(':')
+        tracer.add_hook(getattr(importlib.import_module(module), name))
+
+    def finish():
+        transport.close()
+        tracer.close()
+        if hasattr(writer, 'close'):
+            writer.close()
+        if stats or trace_file:
+            click.echo(tracer.summary(), err=True)
+    ctx.call_on_close(finish)
 
 @cli.group('event')
 def cli_event():
@@ -369,98 +1381,575 @@ def cli_event():
 @click.option('--file', '-f')
 @click.option('--keep-defaults/--filter-defaults', '-D/-d', show_default=True)
 @click.option('--keep-ids/--filter-ids', '-I/-i', default=True, show_default=True)
+@click.option('--jobs', '-j', default=4, show_default=True, help='Number of API requests to run concurrently, per event when sweeping')
+@click.option('--page-size', type=int, help='Number of results to request per list page')
+@click.option('--stream', is_flag=True, help='Write vouchers and subevents page by page instead of keeping them in memory')
+@click.option('--format', type=click.Choice(list(_SERIALIZERS)), help='Output format, defaults to the extension of --file or yaml')
+@click.option('--cache/--no-cache', default=True, show_default=True, help='Reuse and revalidate previously downloaded responses')
+@click.option('--cache-dir', default=_CACHE_DIR, show_default=True)
+@click.option('--cache-ttl', default=0, show_default=True, help='Seconds for which cached responses are used without asking the server')
+@click.option('--cache-size', default=512, show_default=True, help='Maximum cache size in MiB')
+@click.option('--sweep-jobs', default=2, show_default=True, help="Number of events to fetch concurrently when ORGANIZER or EVENT is '*'")
+@click.option('--resume', is_flag=True, help='Skip events whose output file already exists')
+@click.option('--max-age', type=float, help='With --resume, only skip output files younger than this many seconds')
+@click.option('--subevents-after', help='Only fetch subevents starting at or after this date, with their quotas and vouchers')
+@click.option('--subevents-before', help='Only fetch subevents starting at or before this date, with their quotas and vouchers')
 @click.argument('base')
 @click.argument('organizer')
 @click.argument('event')
-def fetch_event(base, organizer, event, file=None, keep_defaults=False, keep_ids=True):
-    _fetch_event_to_file(base, organizer, event, file, keep_defaults, keep_ids)
+def fetch_event(base, organizer, event, file=None, keep_defaults=False, keep_ids=True, jobs=4, page_size=None, stream=False, format=None,
+                cache=True, cache_dir=None, cache_ttl=0, cache_size=512, sweep_jobs=2, resume=False, max_age=None,
+                subevents_after=None, subevents_before=None):
+    # a missing dependency of the output format has to fail before anything is downloaded
+    _serializer_for(file or '', format).check()
+    transport.limit_jobs(jobs * sweep_jobs if organizer == '*' or event == '*' else jobs)
+    if cache:
+        transport.cache = ResponseCache(cache_dir, cache_ttl, cache_size * 1024 * 1024)
+    _fetch_event_to_file(base, organizer, event, file, keep_defaults, keep_ids, jobs, page_size, stream, sweep_jobs, resume, max_age, format,
+                         _subevent_params(subevents_after, subevents_before), transport=transport)
+
+# bulk creation endpoints, relative to the collection
+_BULK_ENDPOINTS = {'vouchers': 'batch_create'}
+
+_CREATE_COLLECTIONS = ['item_meta_properties', 'taxrules', 'categories', 'items', 'subevents', 'quotas', 'vouchers', 'discounts', 'questions']
+
+# fields that are preferably left out on creation and patched in afterwards to break a reference cycle,
+# each group is deferred as a whole
+_DEFERRABLE_FIELDS = {
+    'items': [{'hidden_if_available'}, {'hidden_if_item_available'}],
+    'categories': [{'cross_selling_match_products'}],
+    'questions': [{'dependency_question', 'dependency_value', 'dependency_values'}],
+}
+
+def _plan_creation(event_info, collections, only=None, keep_order=False):
+    if only is None:
+        nodes = [(name, i) for name in collections for i in range(len(event_info.get(name) or []))]
+    else:
+        nodes = sorted((node for node in only if node[0] in collections), key=lambda node: (collections.index(node[0]), node[1]))
+    node_set = set(nodes)
+    field_deps = {node: {} for node in nodes}
+    for name, i in nodes:
+        for field, value in event_info[name][i].items():
+            deps = {tuple(ref.ref[:2]) for _, ref in _refs_with_path(value) if ref.ref and tuple(ref.ref[:2]) in node_set}
+            if deps:
+                field_deps[name, i][field] = deps
+
+    deferred = {node: set() for node in nodes}
+    if keep_order:
+        # a serial run creates objects in file order, so refs to objects listed later are patched in afterwards where possible
+        position = {node: i for i, node in enumerate(nodes)}
+        for node in nodes:
+            later = {field for field, d in field_deps[node].items() if any(position[dep] > position[node] for dep in d)}
+            for group in _DEFERRABLE_FIELDS.get(node[0], []):
+                if group & later:
+                    deferred[node] |= group
+    deps = lambda node: set().union(*(d for field, d in field_deps[node].items() if field not in deferred[node]))
+    done = set()
+    remaining = nodes
+    while remaining:
+        ready = [node for node in remaining if deps(node) <= done]
+        if ready:
+            done.update(ready)
+            remaining = [node for node in remaining if node not in done]
+            continue
+        # everything left waits for something else that is left, so break one of the cycles
+        node, fields = _pick_cycle_break(remaining, field_deps, deferred, deps)
+        deferred[node] |= fields
+    return nodes, {node: deps(node) for node in nodes}, deferred
+
+def _pick_cycle_break(remaining, field_deps, deferred, deps):
+    remaining_set = set(remaining)
+    def in_cycle(start):
+        seen, todo = set(), [start]
+        while todo:
+            for dep in deps(todo.pop()) & remaining_set:
+                if dep == start:
+                    return True
+                if dep not in seen:
+                    seen.add(dep)
+                    todo.append(dep)
+        return False
+    members = [node for node in remaining if in_cycle(node)]
+    blocking = lambda node: {field for field, d in field_deps[node].items() if field not in deferred[node] and d & remaining_set}
+    for node in members:
+        groups = [group for group in _DEFERRABLE_FIELDS.get(node[0], []) if group & blocking(node)]
+        if groups:
+            return node, set().union(*groups)
+    return members[0], blocking(members[0])
+
+def _create_objects(apiref, event_info, resolver, collections=_CREATE_COLLECTIONS, jobs=1, batch_size=1, only=None):
+    with tracer.phase('plan creation'):
+        nodes, deps, deferred = _plan_creation(event_info, collections, only, keep_order=jobs == 1)
+    order = {node: i for i, node in enumerate(nodes)}
+    dependents = {node: [] for node in nodes}
+    for node in nodes:
+        for dep in deps[node]:
+            dependents[dep].append(node)
+    waiting = {node: len(deps[node]) for node in nodes}
+
+    def create(batch):
+        name = batch[0][0]
+        objects = [event_info[name][i] for _, i in batch]
+        bodies = [_without_keys(obj, deferred[node]) for obj, node in zip(objects, batch)]
+        with tracer.phase('create ' + name, count=len(batch)):
+            if len(bodies) > 1:
+                # the response lists the created objects in the order they were sent
+                responses = (apiref / name / _BULK_ENDPOINTS[name]).post(bodies)
+            else:
+                responses = [(apiref / name).post(bodies[0])]
+        for obj, node, response in zip(objects, batch, responses):
+            _deep_update(obj, _without_keys(response, deferred[node]))
+            resolver.invalidate(*node)
+        return batch
+
+    def patch_deferred(node):
+        obj = event_info[node[0]][node[1]]
+        with tracer.phase('patch deferred ' + node[0]):
+            _deep_update(obj, (apiref / node[0] / ('id', obj['id'])).patch({field: obj[field] for field in deferred[node] if field in obj}))
+        resolver.invalidate(*node)
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        try:
+            # ready objects are started in file order, so a serial run creates them in the same order as they are listed
+            ready = [order[node] for node in nodes if not waiting[node]]
+            running = set()
+            while ready or running:
+                while ready and len(running) < jobs:
+                    batch = [nodes[heapq.heappop(ready)]]
+                    # consecutive ready objects of a collection with a bulk endpoint are created together
+                    while ready and batch[0][0] in _BULK_ENDPOINTS and nodes[ready[0]][0] == batch[0][0] and len(batch) < batch_size:
+                        batch.append(nodes[heapq.heappop(ready)])
+                    running.add(pool.submit(create, batch))
+                finished, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    for node in future.result():
+                        for dependent in dependents[node]:
+                            waiting[dependent] -= 1
+                            if not waiting[dependent]:
+                                heapq.heappush(ready, order[dependent])
+            for future in [pool.submit(patch_deferred, node) for node in nodes if deferred[node] & set(event_info[node[0]][node[1]])]:
+                future.result()
+        except:
+            pool.shutdown(cancel_futures=True)
+            raise
 
 @cli_event.command('create')
 @click.option('--force', is_flag=True, help='Force override event, deleting any pre-existing data (incl. orders etc)')
 @click.option('--file', '-f')
 @click.option('--arg', '-a', type=(str, str), multiple=True)
+@click.option('--batch-size', default=100, show_default=True, help='Number of objects per request for collections with a bulk endpoint')
+@click.option('--jobs', '-j', default=1, show_default=True, help='Number of API requests to run concurrently. With more than one, objects without an explicit position may end up in a different order, as may items bundling an item listed after them.')
 @click.argument('base')
 @click.argument('organizer')
 @click.argument('event')
-def create_event(base, organizer, event, arg, force=False, file=None):
-    global ref_root
-    events_base_api = APILink(base, auth_headers) / 'organizers' / ('organizer', organizer) / 'events'
+def create_event(base, organizer, event, arg, force=False, file=None, batch_size=100, jobs=1):
+    transport.limit_jobs(jobs)
+    events_base_api = APILink(base, credentials, transport=transport) / 'organizers' / ('organizer', organizer) / 'events'
     apiref = events_base_api / ('event', event)
-    event_info = _read_yaml(file or ('_'.join(apiref.fpath) + '.yml'))
-    ref_root = event_info
+    with tracer.phase('read'):
+        event_info = _read_event_file(file or ('_'.join(apiref.fpath) + '.yml'))
+    event_info['event']['slug'] = event
+    event_info['args'] = dict(arg)
+    # checked before anything is deleted or created
+    with tracer.phase('check refs'):
+        resolver = RefResolver(event_info)
+        resolver.check()
 
     if force:
+        from requests import RequestException
         try:
             apiref.delete()
         except RequestException as e:
             _print_request_error(e)
 
-    event_info['event']['slug'] = event
-    event_info['args'] = dict(arg)
-
     event_create_body = dict(**event_info['event'])
     event_create_body.pop('live', 0)
     event_create_body.pop('seat_category_mapping', 0)
-    event_response = events_base_api.post(event_create_body)
-
-    (apiref / 'settings').patch(event_info['settings'])
-
-    for item_meta_property in event_info.get('item_meta_properties', []):
-        _deep_update(item_meta_property, (apiref / 'item_meta_properties').post(item_meta_property))
-    for cat in event_info.get('categories', []):
-        cat['id'] = (apiref / 'categories').post(_without_keys(cat, {"cross_selling_match_products"}))['id']
-    for item in event_info.get('items', []):
-        _deep_update(item, (apiref / 'items').post(item))
-    for quota in event_info.get('quotas', []):
-        _deep_update(quota, (apiref / 'quotas').post(quota))
-    for voucher in event_info.get('vouchers', []):
-        _deep_update(voucher, (apiref / 'vouchers').post(voucher))
-    for taxrule in event_info.get('taxrules', []):
-        _deep_update(taxrule, (apiref / 'taxrules').post(taxrule))
-    for discount in event_info.get('discounts', []):
-        _deep_update(discount, (apiref / 'discounts').post(discount))
-    for question in event_info.get('questions', []):
-        question['id'] = (apiref / 'questions').post(_without_keys(question, {"dependency_question", "dependency_value"}))['id']
-
-    # fix circular dependencies
-
-    for category in event_info.get('categories', []):
-        if category.get("cross_selling_match_products"):
-            (apiref / 'categories' / ('category', category['id'])).patch({"cross_selling_match_products": category["cross_selling_match_products"]})
-
-    for question in event_info.get('questions', []):
-        if question.get("dependency_question"):
-            _deep_update(question, (apiref / 'questions' / ('question', question['id'])).patch({"dependency_question": question["dependency_question"]}))
-
-    if event_info['event'].get('live'):
-        apiref.patch({'live': event_info['event']['live']})
-    if event_info['event'].get('seat_category_mapping'):
-        apiref.patch({'seat_category_mapping': event_info['event']['seat_category_mapping']})
+    with tracer.phase('create event'):
+        event_response = events_base_api.post(event_create_body)
+
+        (apiref / 'settings').patch(event_info['settings'])
+
+    with tracer.phase('create objects'):
+        _create_objects(apiref, event_info, resolver, jobs=jobs, batch_size=batch_size)
+
+    with tracer.phase('finish event'):
+        if event_info['event'].get('live'):
+            apiref.patch({'live': event_info['event']['live']})
+        if event_info['event'].get('seat_category_mapping'):
+            apiref.patch({'seat_category_mapping': event_info['event']['seat_category_mapping']})
 
     print("Success: " + event_response['public_url'])
 
+# fields identifying an object that does not carry an id of the target event, in order of preference. A tuple of fields
+# only matches if all of them are equal
+_MATCH_KEYS = {
+    'item_meta_properties': ['name'],
+    'categories': ['internal_name', 'name'],
+    'items': ['internal_name', 'name'],
+    'variations': ['value'],
+    'quotas': ['name'],
+    'vouchers': ['code'],
+    'taxrules': ['internal_name', 'name'],
+    'discounts': ['internal_name'],
+    'questions': ['identifier', 'question'],
+    'subevents': [('date_from', 'name')],
+    'addons': ['addon_category'],
+    'bundles': [('bundled_item', 'bundled_variation'), 'bundled_item'],
+    'options': ['identifier', 'answer'],
+}
+
+# lists inside of objects that are synced through their own endpoints
+_NESTED = {'items': ['variations', 'addons', 'bundles'], 'questions': ['options']}
+
+# collections whose keys are only unique within a subevent, e.g. one quota per date
+_SUBEVENT_KEYED = {'quotas'}
+
+# fields that cannot be changed by patching the object itself
+_READONLY_FIELDS = {
+    'event': {'slug', 'public_url'},
+    'items': {'variations', 'addons', 'bundles'},
+    'questions': {'options'},
+    'vouchers': {'redeemed'},
+    'subevents': {'event'},
+}
+
+# objects are deleted in this order, so nothing is deleted while something else still points at it
+_DELETE_ORDER = ['questions', 'discounts', 'vouchers', 'quotas', 'subevents', 'items', 'categories', 'taxrules', 'item_meta_properties']
+
+_UNRESOLVED = object()
+
+def _normalize(value):
+    # refs to objects that do not exist yet cannot be resolved, which makes them differ from everything
+    try:
+        return json.loads(json.dumps(value, cls=SRJSONEncoder))
+    except (KeyError, IndexError, TypeError):
+        return _UNRESOLVED
+
+def _changed_fields(desired, live, readonly=()):
+    return {key: value for key, value in desired.items()
+            if key != 'id' and key not in readonly and _normalize(value) != live.get(key, _UNRESOLVED)}
+
+def _key_value(obj, field, normalize=lambda value: value):
+    values = [normalize(obj.get(f)) for f in (field if isinstance(field, tuple) else (field,))]
+    # a ref to an object that does not exist yet counts as missing, so the object is new
+    if not any(value is None or value is _UNRESOLVED for value in values):
+        return json.dumps(values if isinstance(field, tuple) else values[0], sort_keys=True)
+
+def _match_key(name, obj):
+    # a subevent yet to be created matches nothing
+    subevent = _normalize(obj.get('subevent')) if name in _SUBEVENT_KEYED else None
+    for field in _MATCH_KEYS.get(name, []):
+        value = _key_value(obj, field, _normalize)
+        if value is not None:
+            return field, value, json.dumps(subevent) if subevent is not _UNRESOLVED else None
+
+def _match_objects(name, desired, live):
+    by_id = {obj['id']: obj for obj in live}
+    by_key = {}
+    for obj in live:
+        subevent = json.dumps(obj.get('subevent') if name in _SUBEVENT_KEYED else None)
+        for field in _MATCH_KEYS.get(name, []):
+            value = _key_value(obj, field)
+            if value is not None:
+                by_key.setdefault((field, value, subevent), obj)
+    matched, new, taken = [], [], set()
+    for i, obj in enumerate(desired):
+        match = by_id.get(obj.get('id'))
+        if match is None or match['id'] in taken:
+            match = by_key.get(_match_key(name, obj))
+        if match is None or match['id'] in taken:
+            # an id from another event must not be used to resolve refs
+            obj.pop('id', None)
+            new.append(i)
+            continue
+        taken.add(match['id'])
+        obj['id'] = match['id']
+        matched.append((obj, match))
+    return matched, new, [obj for obj in live if obj['id'] not in taken]
+
+def _sync_event(apiref, event_info, resolver, collections, synced, jobs=1, batch_size=1, prune=False, dry_run=False, subevent_params=None):
+    with tracer.phase('fetch live'), ThreadPoolExecutor(max_workers=jobs) as pool:
+        live_event = pool.submit(apiref.fetch_single)
+        live_settings = pool.submit((apiref / 'settings').fetch_single)
+        live = {name: pool.submit((apiref / name).fetch_all, None, jobs, subevent_params if name == 'subevents' else None) for name in collections}
+        live_event, live_settings = live_event.result(), live_settings.result()
+        live = {name: future.result() for name, future in live.items()}
+    if 'subevents' in live:
+        # objects of subevents outside of the date range are neither matched nor pruned
+        subevent_ids = {subevent['id'] for subevent in live['subevents']}
+        for name in _SUBEVENT_BOUND:
+            if name in live:
+                live[name] = _drop_other_subevents(live[name], subevent_ids)
+
+    updates = [(apiref, event_info['event'], live_event, _READONLY_FIELDS['event'])]
+    if 'settings' in event_info:
+        updates.append((apiref / 'settings', event_info['settings'], live_settings, ()))
+    creates, nested_creates, deletes = set(), [], {}
+    with tracer.phase('match'):
+        for name in collections:
+            # every collection is matched so refs into it resolve, but only the synced ones are changed
+            matched, new, extra = _match_objects(name, event_info[name], live[name])
+            nested = [(apiref / name / ('id', l['id']) / key, key, d, _match_objects(key, d.get(key) or [], l.get(key) or []))
+                      for d, l in matched for key in _NESTED.get(name, [])]
+            if name not in synced:
+                continue
+            creates |= {(name, i) for i in new}
+            updates += [(apiref / name / ('id', l['id']), d, l, _READONLY_FIELDS.get(name, ())) for d, l in matched]
+            deletes[name] = [apiref / name / ('id', l['id']) for l in extra] if prune else []
+            for link, key, obj, (n_matched, n_new, n_extra) in nested:
+                nested_creates += [(link, key, obj[key][i]) for i in n_new]
+                updates += [(link / (key[:-1], nl['id']), nd, nl, ()) for nd, nl in n_matched]
+                deletes[name] += [link / (key[:-1], nl['id']) for nl in n_extra] if prune else []
+    # matching replaced the ids from the file by those of the live objects
+    resolver.invalidate()
+
+    if dry_run:
+        for link, key, obj in nested_creates:
+            print("POST  ", link)
+        for name, i in sorted(creates, key=lambda node: (collections.index(node[0]), node[1])):
+            print("POST  ", apiref / name, (_match_key(name, event_info[name][i]) or ('#', i))[1])
+        for link, desired, current, readonly in updates:
+            changed = _changed_fields(desired, current, readonly)
+            if changed:
+                print("PATCH ", link, ", ".join(changed))
+        for name in _DELETE_ORDER:
+            for link in deletes.get(name, []):
+                print("DELETE", link)
+        return live_event
+
+    # new variations may be referred to by new quotas, while addons can only refer to categories once these exist
+    with tracer.phase('create variations'), ThreadPoolExecutor(max_workers=jobs) as pool:
+        for future in [pool.submit(lambda link, obj: _deep_update(obj, link.post(obj)), link, obj) for link, key, obj in nested_creates if key == 'variations']:
+            future.result()
+    resolver.invalidate()
+    with tracer.phase('create objects'):
+        _create_objects(apiref, event_info, resolver, collections, jobs, batch_size, only=creates)
+    with tracer.phase('create nested'), ThreadPoolExecutor(max_workers=jobs) as pool:
+        for future in [pool.submit(link.post, obj) for link, key, obj in nested_creates if key != 'variations']:
+            future.result()
+    # bodies are built after creating, so refs to new objects resolve
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        with tracer.phase('patch'):
+            patches = [(link, _changed_fields(desired, current, readonly)) for link, desired, current, readonly in updates]
+            for future in [pool.submit(link.patch, body) for link, body in patches if body]:
+                future.result()
+        with tracer.phase('delete'):
+            for name in _DELETE_ORDER:
+                for future in [pool.submit(link.delete) for link in deletes.get(name, [])]:
+                    future.result()
+    return live_event
+
 @cli_event.command('update')
 @click.option('--file', '-f')
-@click.option('--discounts', is_flag=True)
+@click.option('--arg', '-a', type=(str, str), multiple=True)
+@click.option('--collection', '-c', 'collections', multiple=True, type=click.Choice(_CREATE_COLLECTIONS),
+              help='Collections to sync, defaults to all collections in the file')
+@click.option('--prune/--no-prune', default=False, show_default=True, help='Delete objects of synced collections that are not in the file')
+@click.option('--dry-run', is_flag=True, help='Print the planned API calls without executing them')
+@click.option('--batch-size', default=100, show_default=True, help='Number of objects per request for collections with a bulk endpoint')
+@click.option('--jobs', '-j', default=1, show_default=True, help='Number of API requests to run concurrently')
+@click.option('--subevents-after', help='Only sync subevents starting at or after this date, with their quotas and vouchers')
+@click.option('--subevents-before', help='Only sync subevents starting at or before this date, with their quotas and vouchers')
+# kept for compatibility, discounts are synced like every other collection
+@click.option('--discounts', is_flag=True, hidden=True)
 @click.argument('base')
 @click.argument('organizer')
 @click.argument('event')
-def update_event(base, organizer, event, file=None, discounts=False):
-    global ref_root
-    events_base_api = APILink(base, auth_headers) / 'organizers' / ('organizer', organizer) / 'events'
+def update_event(base, organizer, event, arg=(), file=None, collections=(), prune=False, dry_run=False, batch_size=100, jobs=1,
+                 subevents_after=None, subevents_before=None, discounts=False):
+    transport.limit_jobs(jobs)
+    events_base_api = APILink(base, credentials, transport=transport) / 'organizers' / ('organizer', organizer) / 'events'
     apiref = events_base_api / ('event', event)
-    event_info = _read_yaml(file or ('_'.join(apiref.fpath) + '.yml'))
-    ref_root = event_info
-
-    event_response = apiref.patch(_without_keys(event_info['event'], {'slug'}))
-    (apiref / 'settings').patch(event_info['settings'])
-
-    if discounts:
-        for old_discount in (apiref / 'discounts').fetch_all():
-            (apiref / 'discounts' / ('discount', old_discount['id'])).delete()
-        for discount in event_info['discounts']:
-            _deep_update(discount, (apiref / 'discounts').post(discount))
-
+    with tracer.phase('read'):
+        event_info = _read_event_file(file or ('_'.join(apiref.fpath) + '.yml'))
+    event_info['event']['slug'] = event
+    event_info['args'] = dict(arg)
+    with tracer.phase('check refs'):
+        resolver = RefResolver(event_info)
+        resolver.check()
+
+    # a collection missing from the file is left alone instead of being emptied
+    present = [name for name in _CREATE_COLLECTIONS if name in event_info]
+    event_response = _sync_event(apiref, event_info, resolver, present, collections or present, jobs, batch_size, prune, dry_run,
+                                 _subevent_params(subevents_after, subevents_before))
+
+    if not dry_run:
+        print("Success: " + event_response['public_url'])
+
+
+# streamed collections that nothing refers to, so they can be created page by page while they are still being fetched
+_PAGED_COLLECTIONS = [name for name in _STREAMED_COLLECTIONS if all(_section(to_where) != name for _, to_where, _ in _REF_RULES)]
+
+def _creation_units(collections):
+    # collections referring to each other, like categories and items, are created together, each unit after those it refers to
+    refs = {name: {_section(to_where) for where, to_where, _ in _REF_RULES if _section(where) == name and _section(to_where) in collections} - {name}
+            for name in collections}
+    def reachable(name):
+        seen, todo = set(), [name]
+        while todo:
+            for target in refs[todo.pop()] - seen:
+                seen.add(target)
+                todo.append(target)
+        return seen
+    reach = {name: reachable(name) for name in collections}
+    units = []
+    for name in collections:
+        if not any(name in unit for unit in units):
+            units.append([other for other in collections if other == name or (other in reach[name] and name in reach[other])])
+    return [(unit, set().union(*(refs[name] for name in unit)) - set(unit)) for unit in units]
+
+def _clone_event(src, dst_events, dst, slug, jobs=1, page_size=None, batch_size=1, defaults=None, subevent_params=None, force=False):
+    # fetched collections are passed to the main thread through the queue, which resolves their refs and starts creating
+    # them as soon as everything they refer to exists in the target event
+    messages = queue.Queue()
+    event_info = {name: [] for name in _PAGED_COLLECTIONS}
+    resolver = RefResolver(event_info)
+    ref_index = RefIndex(event_info)
+
+    def submit(pool, kind, key, fn, *args):
+        pool.submit(fn, *args).add_done_callback(lambda future: messages.put((kind, key, future)))
+
+    def fetch(name, params=None):
+        if name not in _PAGED_COLLECTIONS:
+            return (src / name).fetch_all(page_size, jobs, params)
+        for page in (src / name).iter_pages(page_size, jobs, params):
+            messages.put(('page', name, page))
+        return []
+
+    def receive(name, objects):
+        # indexed before the ids are stripped, which makes sure that nothing is created with an id of the source event
+        for to_where, to_what in dict.fromkeys((to_where, to_what) for _, to_where, to_what in _REF_RULES if _section(to_where) == name):
+            ref_index.extend(to_where, to_what, {name: objects})
+        event_info[name] = objects
+
+    def prepare(name, objects):
+        if name in _SUBEVENT_BOUND and 'subevents' in event_info:
+            objects = _drop_other_subevents(objects, ref_index.lookup('.subevents.*', '.id'))
+        with tracer.phase('fixup refs'):
+            _fixup_refs({name: objects}, [rule for rule in _REF_RULES if _section(rule[0]) == name and _section(rule[1]) in event_info], ref_index)
+        _strip_event_data({name: objects}, defaults, False, sections=[name])
+        resolver.bind(objects)
+        return objects
+
+    fetch_pool, create_pool = ThreadPoolExecutor(max_workers=jobs), ThreadPoolExecutor(max_workers=jobs)
+    try:
+        source_event = fetch_pool.submit(src.fetch_single)
+        source_settings = fetch_pool.submit((src / 'settings').fetch_single)
+        # collections are fetched in the order they are created in, so subevents have to wait for the event
+        event = source_event.result()
+        collections = [name for name in _CREATE_COLLECTIONS if name != 'subevents' or event['has_subevents']]
+        for name in collections:
+            submit(fetch_pool, 'fetched', name, fetch, name, subevent_params if name == 'subevents' else None)
+
+        if force:
+            from requests import RequestException
+            try:
+                dst.delete()
+            except RequestException as e:
+                _print_request_error(e)
+        event_create_body = deepcopy(event)
+        _strip_event_data({'event': event_create_body}, defaults, True, sections=['event'])
+        event_create_body['slug'] = slug
+        event_create_body.pop('live', 0)
+        event_create_body.pop('seat_category_mapping', 0)
+        with tracer.phase('create event'):
+            event_response = dst_events.post(event_create_body)
+            settings = source_settings.result()
+            _strip_event_data({'settings': settings}, defaults, True, sections=['settings'])
+            (dst / 'settings').patch(settings)
+        event_info['event'] = event
+
+        sections = ['event'] + collections
+        targets = {name: {_section(to_where) for where, to_where, _ in _REF_RULES if _section(where) == name} & set(collections) for name in sections}
+        units = _creation_units(collections)
+        fetched, prepared, created = {'event'}, set(), set()
+        pages = {name: [] for name in _PAGED_COLLECTIONS}
+        in_flight = {}
+
+        def progress():
+            changed = False
+            for name in sections:
+                if name in fetched and name not in prepared and name not in _PAGED_COLLECTIONS and targets[name] <= fetched:
+                    event_info[name] = prepare(name, event_info[name])
+                    prepared.add(name)
+                    changed = True
+            for i, (unit, requires) in enumerate(units):
+                if unit[0] in created or not requires <= created:
+                    continue
+                if unit[0] in _PAGED_COLLECTIONS:
+                    name = unit[0]
+                    while pages[name]:
+                        page = prepare(name, pages[name].pop(0))
+                        offset = len(event_info[name])
+                        event_info[name].extend(page)
+                        submit(create_pool, 'created', i, _create_objects, dst, event_info, resolver, [name], 1, batch_size,
+                               {(name, j) for j in range(offset, offset + len(page))})
+                        in_flight[i] = in_flight.get(i, 0) + 1
+                    done = name in fetched and not in_flight.get(i)
+                elif i not in in_flight:
+                    if all(name in prepared for name in unit):
+                        submit(create_pool, 'created', i, _create_objects, dst, event_info, resolver, unit, jobs, batch_size)
+                        in_flight[i] = 1
+                    done = False
+                else:
+                    done = not in_flight[i]
+                if done:
+                    created.update(unit)
+                    changed = True
+            return changed
+
+        while len(created) < len(collections):
+            kind, key, value = messages.get()
+            if kind == 'page':
+                pages[key].append(value)
+            elif kind == 'fetched':
+                objects = value.result()
+                if key not in _PAGED_COLLECTIONS:
+                    receive(key, objects)
+                fetched.add(key)
+            else:
+                value.result()
+                in_flight[key] -= 1
+            while progress():
+                pass
+    except:
+        fetch_pool.shutdown(cancel_futures=True)
+        create_pool.shutdown(cancel_futures=True)
+        raise
+    fetch_pool.shutdown()
+    create_pool.shutdown()
+
+    with tracer.phase('finish event'):
+        if event_info['event'].get('live'):
+            dst.patch({'live': event_info['event']['live']})
+        if event_info['event'].get('seat_category_mapping'):
+            dst.patch({'seat_category_mapping': event_info['event']['seat_category_mapping']})
+    return event_response
+
+@cli_event.command('clone')
+@click.option('--force', is_flag=True, help='Force override the target event, deleting any pre-existing data (incl. orders etc)')
+@click.option('--jobs', '-j', default=4, show_default=True, help='Number of API requests to run concurrently on each instance. Objects without an explicit position may end up in a different order.')
+@click.option('--page-size', type=int, help='Number of results to request per list page')
+@click.option('--batch-size', default=100, show_default=True, help='Number of objects per request for collections with a bulk endpoint')
+@click.option('--subevents-after', help='Only clone subevents starting at or after this date, with their quotas and vouchers')
+@click.option('--subevents-before', help='Only clone subevents starting at or before this date, with their quotas and vouchers')
+@click.argument('src_base')
+@click.argument('src_organizer')
+@click.argument('src_event')
+@click.argument('dst_base')
+@click.argument('dst_organizer')
+@click.argument('dst_event')
+def clone_event(src_base, src_organizer, src_event, dst_base, dst_organizer, dst_event, force=False, jobs=4, page_size=None, batch_size=100,
+                subevents_after=None, subevents_before=None):
+    transport.limit_jobs(jobs)
+    src = APILink(src_base, credentials, transport=transport) / 'organizers' / ('organizer', src_organizer) / 'events' / ('event', src_event)
+    dst_events = APILink(dst_base, credentials, transport=transport) / 'organizers' / ('organizer', dst_organizer) / 'events'
+    with tracer.phase('load defaults'):
+        defaults = _load_defaults()
+    with tracer.phase('clone', source=src_event, target=dst_event):
+        event_response = _clone_event(src, dst_events, dst_events / ('event', dst_event), dst_event, jobs, page_size, batch_size, defaults,
+                                      _subevent_params(subevents_after, subevents_before), force)
     print("Success: " + event_response['public_url'])
 
 
@@ -472,7 +1961,7 @@ def cli_auth():
 @click.argument('base')
 def oauth_grant(base):
     oauth_conf = _read_yaml('oauth.yml')
-    link = APILink(base, {})
+    link = APILink(base, {}, transport=transport)
     conf = oauth_conf[link.api_base]
     link._headers = {
         link.api_base: {
@@ -507,7 +1996,5 @@ def oauth_grant(base):
     oauth_conf[link.api_base]['expires'] = int(time.time()) + int(response['expires_in'])
     _write_yaml('oauth.yml', oauth_conf)
 
-auth_headers = _read_yaml('auth.yml')
-
 if __name__ == '__main__':
     cli()
\ No newline at end of file